@@ -1,80 +1,490 @@
-import boto3
-from boto3.dynamodb.conditions import Attr
+from concurrent.futures import ThreadPoolExecutor
 import os
+import queue
+import random
+import threading
+import time
 from dotenv import load_dotenv
 import pandas as pd
 from datetime import datetime, timedelta
 import sys
 
-os.environ.pop('TABLE_NAME', None)
-os.environ.pop('REGION', None)
-# os.environ.pop('FULL_YEAR', None)
-# os.environ.pop('FULL_MONTH', None)
-# os.environ.pop('FULL_DAY', None)
-load_dotenv()
-table_name = os.getenv('TABLE_NAME')
-region_name = os.getenv('REGION')
+import item_store
+import metrics
+from schemas import ITEM_SCHEMA, to_frame
+from time_utils import JST
 
+# boto3 is imported where DynamoDB is called, so loading this stage for
+# split_items_by_day (local backend) does not pay for it
+THROTTLING_ERRORS = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+)
+MAX_RETRIES = 8
+BASE_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 20
 
-if len(sys.argv) >= 4:
-    year = sys.argv[1]
-    month = sys.argv[2]
-    day = sys.argv[3]
-else:
-    year = os.getenv('FULL_YEAR')
-    month = os.getenv('FULL_MONTH')
-    day = os.getenv('FULL_DAY')
+# Re-read this much before the stored watermark to catch late or skewed writes
+WATERMARK_OVERLAP_SECONDS = 60 * 60
 
-def download_items_from_dynamodb(table_name, region_name, start_date=None, end_date=None):
+# Partition key of the optional date-keyed secondary index (JST 'YYYY-MM-DD')
+DEFAULT_INDEX_KEY = 'created_date'
+
+# Attributes consumed by 2.beautify.py and 3.pivot.py
+ITEM_ATTRIBUTES = [
+    'request_id',
+    'created_at',
+    'expired_at',
+    'flow_assessment',
+    'processing_at',
+    'sent_at',
+    'updated_at',
+    'submitted_at',
+    'request_status',
+    'sms_status',
+    'answer',
+    'total_price',
+    'reason_cancel',
+]
+
+
+def jst_epoch(date_str):
+    """Return the epoch seconds of 00:00 JST on a 'YYYY-MM-DD' date."""
+    return int(datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=JST).timestamp())
+
+
+class AdaptiveLimiter:
+    """
+    Caps the number of in-flight scan requests.
+
+    The cap is halved every time DynamoDB throttles and grows back by one after
+    a run of successful pages, so a parallel scan settles at whatever rate the
+    table's read capacity allows.
+    """
+
+    def __init__(self, max_concurrency, recover_after=10):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.recover_after = recover_after
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def throttled(self):
+        with self._cond:
+            self._successes = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                print(f"[WARNING] DynamoDB throttled, reducing scan concurrency to {self.limit}")
+
+    def succeeded(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.recover_after and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+
+def build_projection_kwargs():
+    """Build a ProjectionExpression limited to ITEM_ATTRIBUTES."""
+    # Placeholders avoid clashes with DynamoDB reserved words
+    names = {f"#p{i}": attribute for i, attribute in enumerate(ITEM_ATTRIBUTES)}
+    return {
+        'ProjectionExpression': ", ".join(names),
+        'ExpressionAttributeNames': names,
+    }
+
+
+def build_scan_kwargs(start_date=None, end_date=None, updated_since=None):
+    """
+    Build the FilterExpression for a scan between two dates.
+
+    With updated_since (epoch seconds) only items created or updated at or after
+    that time are kept.
+    """
+    from boto3.dynamodb.conditions import Attr
+
+    scan_kwargs = {}
+    if start_date and end_date:
+        start_ts = jst_epoch(start_date)
+        end_ts = jst_epoch(end_date)
+        scan_kwargs['FilterExpression'] = Attr('created_at').between(start_ts, end_ts)
+    elif start_date:
+        start_ts = jst_epoch(start_date)
+        scan_kwargs['FilterExpression'] = Attr('created_at').gte(start_ts)
+    elif end_date:
+        end_ts = jst_epoch(end_date)
+        scan_kwargs['FilterExpression'] = Attr('created_at').lte(end_ts)
+
+    if updated_since is not None:
+        changed = Attr('updated_at').gte(updated_since) | Attr('created_at').gte(updated_since)
+        if 'FilterExpression' in scan_kwargs:
+            changed = scan_kwargs['FilterExpression'] & changed
+        scan_kwargs['FilterExpression'] = changed
+    return scan_kwargs
+
+
+def read_page(operation, request_kwargs, limiter):
+    """Run one Scan/Query request, backing off with jitter while DynamoDB throttles."""
+    from botocore.exceptions import ClientError
+
+    request_kwargs = {**request_kwargs, 'ReturnConsumedCapacity': 'TOTAL'}
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with limiter:
+                start = time.perf_counter()
+                response = operation(**request_kwargs)
+                metrics.observe(f"dynamodb.{operation.__name__}", time.perf_counter() - start)
+            limiter.succeeded()
+            metrics.count("dynamodb.pages")
+            metrics.count("dynamodb.items", response.get('Count', 0))
+            metrics.count("dynamodb.scanned_items", response.get('ScannedCount', 0))
+            metrics.count("dynamodb.consumed_capacity",
+                          float(response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)))
+            return response
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in THROTTLING_ERRORS or attempt == MAX_RETRIES:
+                raise
+            metrics.count("dynamodb.throttled")
+            limiter.throttled()
+            delay = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+
+
+def iter_pages(operation, request_kwargs, limiter):
+    """Follow LastEvaluatedKey until the Scan/Query is exhausted, yielding each page's items."""
+    response = read_page(operation, request_kwargs, limiter)
+    yield response.get('Items', [])
+
+    while 'LastEvaluatedKey' in response:
+        response = read_page(operation, {**request_kwargs, 'ExclusiveStartKey': response['LastEvaluatedKey']}, limiter)
+        yield response.get('Items', [])
+
+
+def get_table(table_name, region_name):
+    import boto3
+
+    # boto3 resources are not thread-safe, so every worker gets its own session
+    dynamodb = boto3.session.Session().resource('dynamodb', region_name=region_name)
+    return dynamodb.Table(table_name)
+
+
+def scan_segment(table_name, region_name, scan_kwargs, limiter, segment=None, total_segments=None):
+    """Read one scan segment, yielding its pages of items."""
+    table = get_table(table_name, region_name)
+
+    scan_kwargs = dict(scan_kwargs)
+    if total_segments and total_segments > 1:
+        scan_kwargs['Segment'] = segment
+        scan_kwargs['TotalSegments'] = total_segments
+
+    yield from iter_pages(table.scan, scan_kwargs, limiter)
+
+
+def query_index_day(table_name, region_name, query_kwargs, limiter, index_name, index_key, date_str):
+    """Query one JST date partition of the date-keyed secondary index, yielding its pages of items."""
+    from boto3.dynamodb.conditions import Key
+
+    table = get_table(table_name, region_name)
+    query_kwargs = dict(query_kwargs)
+    query_kwargs['IndexName'] = index_name
+    query_kwargs['KeyConditionExpression'] = Key(index_key).eq(date_str)
+    yield from iter_pages(table.query, query_kwargs, limiter)
+
+
+def stream_items_from_dynamodb(table_name, region_name, start_date=None, end_date=None, total_segments=1,
+                               index_name=None, index_key=DEFAULT_INDEX_KEY, updated_since=None):
+    """
+    Yield pages of items (lists of dicts) as the Scan/Query segments return them.
+
+    Takes the same arguments as download_items_from_dynamodb. Segments run on
+    worker threads that hand pages over through a small bounded queue, so only
+    a few pages are held in memory however large the result is.
+    """
+    if index_name and start_date and end_date:
+        # The key condition already selects the JST created dates; no created_at filter
+        request_kwargs = build_scan_kwargs(updated_since=updated_since)
+    else:
+        request_kwargs = build_scan_kwargs(start_date, end_date, updated_since)
+    request_kwargs.update(build_projection_kwargs())
+    total_segments = max(1, int(total_segments or 1))
+    limiter = AdaptiveLimiter(total_segments)
+
+    if index_name and start_date and end_date:
+        first = datetime.strptime(start_date, "%Y-%m-%d")
+        num_days = (datetime.strptime(end_date, "%Y-%m-%d") - first).days + 1
+        date_strs = [(first + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(num_days)]
+        tasks = [
+            (query_index_day, table_name, region_name, request_kwargs, limiter, index_name, index_key, date_str)
+            for date_str in date_strs
+        ]
+    elif total_segments > 1:
+        tasks = [
+            (scan_segment, table_name, region_name, request_kwargs, limiter, segment, total_segments)
+            for segment in range(total_segments)
+        ]
+    else:
+        tasks = [(scan_segment, table_name, region_name, request_kwargs, limiter)]
+
+    pages = queue.Queue(maxsize=2 * total_segments)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(func, *args):
+        try:
+            for page in func(*args):
+                if not put(page):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    with ThreadPoolExecutor(max_workers=min(total_segments, len(tasks))) as executor:
+        for task in tasks:
+            executor.submit(run, *task)
+        remaining = len(tasks)
+        try:
+            while remaining:
+                entry = pages.get()
+                if isinstance(entry, tuple) and entry[0] is done:
+                    remaining -= 1
+                    if entry[1] is not None:
+                        raise entry[1]
+                    continue
+                yield entry
+        finally:
+            # Let the workers exit if the consumer stopped early or a segment failed
+            stop.set()
+
+
+def download_items_from_dynamodb(table_name, region_name, start_date=None, end_date=None, total_segments=1,
+                                 index_name=None, index_key=DEFAULT_INDEX_KEY, updated_since=None):
     """
     Download items from a DynamoDB table between two dates.
 
+    With index_name set, each JST date in the range is read with a Query against
+    that secondary index (partition key index_key = 'YYYY-MM-DD'); otherwise the
+    table is scanned. With total_segments > 1 the scan is split into parallel
+    segments, or the per-date queries run on that many threads. Throttling is
+    retried with backoff; any other error is raised. Only ITEM_ATTRIBUTES are
+    fetched, so the index must project all of them.
+
     :param table_name: Name of the DynamoDB table
     :param region_name: AWS region where the table is located
-    :param start_date: Start date string in 'YYYY-MM-DD' format
-    :param end_date: End date string in 'YYYY-MM-DD' format
+    :param start_date: Start date string in 'YYYY-MM-DD' format (00:00 JST)
+    :param end_date: End date string in 'YYYY-MM-DD' format (00:00 JST)
+    :param total_segments: Number of parallel scan segments / query threads
+    :param index_name: Date-keyed secondary index to query instead of scanning
+    :param index_key: Partition key attribute of that index
+    :param updated_since: Only fetch items created or updated at/after this epoch
     :return: List of items from the table
     """
-    dynamodb = boto3.resource('dynamodb', region_name=region_name)
-    table = dynamodb.Table(table_name)
-
-    try:
-        scan_kwargs = {}
-        if start_date and end_date:
-            start_ts = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp())
-            end_ts = int(datetime.strptime(end_date, "%Y-%m-%d").timestamp())
-            scan_kwargs['FilterExpression'] = Attr('created_at').between(start_ts, end_ts)
-        elif start_date:
-            start_ts = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp())
-            scan_kwargs['FilterExpression'] = Attr('created_at').gte(start_ts)
-        elif end_date:
-            end_ts = int(datetime.strptime(end_date, "%Y-%m-%d").timestamp())
-            scan_kwargs['FilterExpression'] = Attr('created_at').lte(end_ts)
-
-        response = table.scan(**scan_kwargs)
-        items = response.get('Items', [])
-
-        while 'LastEvaluatedKey' in response:
-            response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_kwargs)
-            items.extend(response.get('Items', []))
-
-        return items
-    except Exception as e:
-        print(f"Error downloading items from DynamoDB: {e}")
-        return []
+    items = []
+    for page in stream_items_from_dynamodb(table_name, region_name, start_date, end_date, total_segments,
+                                           index_name, index_key, updated_since):
+        items.extend(page)
+    return items
+
+
+def iter_item_frames(pages, batch_rows):
+    """Regroup pages of items into DataFrames of about batch_rows items."""
+    buffer = []
+    for page in pages:
+        buffer.extend(page)
+        if len(buffer) >= batch_rows:
+            yield pd.DataFrame(buffer)
+            buffer = []
+    if buffer:
+        yield pd.DataFrame(buffer)
+
+
+def download_items_to_store(table_name, region_name, start_date=None, end_date=None, total_segments=1,
+                            index_name=None, index_key=DEFAULT_INDEX_KEY, updated_since=None,
+                            batch_rows=100_000, store_dir=item_store.DEFAULT_STORE_DIR, replace=False,
+                            replace_dates=()):
+    """
+    Stream items from DynamoDB into the item store in batches of batch_rows.
+
+    Pages are spooled to disk as they arrive and merged into the store one date
+    partition at a time, so memory stays bounded by one batch and one day.
+    The partitions of replace_dates ('YYYY-MM-DD' days the read fully covers)
+    are replaced rather than merged.
+
+    :return: (number of items fetched, dates of the partitions written, newest change time)
+    """
+    pages = stream_items_from_dynamodb(table_name, region_name, start_date, end_date, total_segments,
+                                       index_name, index_key, updated_since)
+    return item_store.upsert_batches(iter_item_frames(pages, batch_rows), store_dir, replace, replace_dates)
+
+
+def read_window(first_day, last_day, index_name=None):
+    """
+    First and last date ('YYYY-MM-DD') to read for the days first_day..last_day.
+
+    A scan filters on created_at from day - 1 to day + 1 (00:00 JST). The index
+    is keyed by the JST created date itself, so only the days are queried:
+    a Query is charged before its filter, and each extra date costs a partition read.
+    """
+    if index_name:
+        return first_day.strftime("%Y-%m-%d"), last_day.strftime("%Y-%m-%d")
+    return (
+        (first_day - timedelta(days=1)).strftime("%Y-%m-%d"),
+        (last_day + timedelta(days=1)).strftime("%Y-%m-%d"),
+    )
+
+
+def download_items_for_date(table_name, region_name, year, month, day, total_segments=1,
+                            index_name=None, index_key=DEFAULT_INDEX_KEY):
+    """
+    Download the items around one day (day-1 to day+1; only the day with index_name) as a DataFrame.
+
+    :return: DataFrame of DynamoDB items conformed to ITEM_SCHEMA
+    """
+    target = datetime.strptime(f"{year}-{month}-{day}", "%Y-%m-%d")
+    date_filter, to_date = read_window(target, target, index_name)
+    items = download_items_from_dynamodb(table_name, region_name, date_filter, to_date, total_segments,
+                                         index_name, index_key)
+    print(f"Downloaded {len(items)} items from DynamoDB table '{table_name}' with date filter '{date_filter}'.")
+    return to_frame(pd.DataFrame(items), ITEM_SCHEMA)
+
+
+def download_items_for_range(table_name, region_name, dates, total_segments=1,
+                             index_name=None, index_key=DEFAULT_INDEX_KEY,
+                             store_dir=item_store.DEFAULT_STORE_DIR, batch_rows=None):
+    """
+    Scan once for a whole span of days and split the items per JST created date.
+
+    The scan covers the first day - 1 to the last day + 1, the same margin used
+    for a single day, so a month costs one table scan instead of one per day
+    (with index_name, only the days themselves are queried; see read_window).
+    The items are also saved to the local item store, replacing the requested
+    days' partitions, so items deleted from the table do not linger there.
+
+    With batch_rows the items are streamed into the store in batches (see
+    download_items_to_store) and the days are read back from it on access.
+
+    :param dates: List of (year, month, day) string tuples
+    :return: Mapping of each (year, month, day) to a DataFrame of its items
+    """
+    days = sorted(datetime.strptime(f"{y}-{m}-{d}", "%Y-%m-%d") for y, m, d in dates)
+    date_filter, to_date = read_window(days[0], days[-1], index_name)
+    covered = [day.strftime("%Y-%m-%d") for day in days]
+    if batch_rows:
+        count, _, _ = download_items_to_store(table_name, region_name, date_filter, to_date, total_segments,
+                                              index_name, index_key, batch_rows=batch_rows, store_dir=store_dir,
+                                              replace_dates=covered)
+        print(f"Streamed {count} items from DynamoDB table '{table_name}' for {date_filter} to {to_date}.")
+        return item_store.PartitionView(dates, store_dir)
+    items = download_items_from_dynamodb(table_name, region_name, date_filter, to_date, total_segments,
+                                         index_name, index_key)
+    print(f"Downloaded {len(items)} items from DynamoDB table '{table_name}' for {date_filter} to {to_date}.")
+    df = to_frame(pd.DataFrame(items), ITEM_SCHEMA)
+    item_store.upsert_items(df, store_dir, replace_dates=covered)
+    return split_items_by_day(df, dates)
+
+
+def sync_items_incremental(table_name, region_name, store_dir=item_store.DEFAULT_STORE_DIR,
+                           full_refresh=False, total_segments=1, batch_rows=None):
+    """
+    Bring the local item store up to date and return its contents.
+
+    Only items created or updated since the stored watermark are fetched and
+    upserted by request_id. The first sync, or full_refresh=True, scans the whole
+    table and replaces the store (this is also how deleted items get dropped).
+    Read the days back with item_store.load_items. With batch_rows the items
+    are streamed into the store in batches (see download_items_to_store).
+
+    :return: Number of items fetched
+    """
+    watermark = None if full_refresh else item_store.read_watermark(store_dir)
+    updated_since = None if watermark is None else watermark - WATERMARK_OVERLAP_SECONDS
+
+    if batch_rows:
+        count, written, latest = download_items_to_store(
+            table_name, region_name, total_segments=total_segments, updated_since=updated_since,
+            batch_rows=batch_rows, store_dir=store_dir, replace=updated_since is None
+        )
+    else:
+        items = download_items_from_dynamodb(table_name, region_name, total_segments=total_segments,
+                                             updated_since=updated_since)
+        changed = pd.DataFrame(items)
+        written = item_store.upsert_items(changed, store_dir, replace=updated_since is None)
+        count = len(items)
+        latest = item_store.max_change_time(changed)
+
+    if latest is not None and (watermark is None or latest > watermark):
+        item_store.write_watermark(latest, store_dir)
+
+    mode = "Full refresh" if updated_since is None else f"Incremental sync since {updated_since}"
+    print(f"{mode}: {count} changed items written to {len(written)} date partitions.")
+    return count
+
+
+def split_items_by_day(df, dates):
+    """
+    Partition items by the JST date of created_at.
+
+    :param df: DataFrame of raw DynamoDB items
+    :param dates: List of (year, month, day) string tuples
+    :return: Dict mapping each (year, month, day) to a DataFrame of its items
+    """
+    if df.empty or 'created_at' not in df.columns:
+        return {date: pd.DataFrame() for date in dates}
+
+    created_dates = item_store.partition_dates(df)
+    return {
+        (year, month, day): df[created_dates == f"{year}-{month}-{day}"].reset_index(drop=True)
+        for year, month, day in dates
+    }
+
 
 # Example usage
 if __name__ == "__main__":
-    date_filter = (datetime.strptime(f"{year}-{month}-{day}", "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-    to_date = (datetime.strptime(f"{year}-{month}-{day}", "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-    items = download_items_from_dynamodb(table_name, region_name, date_filter, to_date)
-
-    # Save items to a CSV file
-    df = pd.DataFrame(items)
-    output_filepath = "data/items.csv"
-    
-    # Ensure data directory exists
-    os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
-    df.to_csv(output_filepath, index=False)
-
-    print(f"Downloaded {len(items)} items from DynamoDB table '{table_name}' with date filter '{date_filter}'. {sys.argv}")
+    os.environ.pop('TABLE_NAME', None)
+    os.environ.pop('REGION', None)
+    load_dotenv()
+    table_name = os.getenv('TABLE_NAME')
+    region_name = os.getenv('REGION')
+    total_segments = int(os.getenv('SCAN_SEGMENTS', '1'))
+    index_name = os.getenv('ITEMS_INDEX_NAME')
+    index_key = os.getenv('ITEMS_INDEX_KEY', DEFAULT_INDEX_KEY)
+
+    if len(sys.argv) >= 4:
+        year = sys.argv[1]
+        month = sys.argv[2]
+        day = sys.argv[3]
+    else:
+        year = os.getenv('FULL_YEAR')
+        month = os.getenv('FULL_MONTH')
+        day = os.getenv('FULL_DAY')
+
+    df = download_items_for_date(table_name, region_name, year, month, day, total_segments,
+                                 index_name, index_key)
+
+    # Save items to the date-partitioned item store
+    written = item_store.upsert_items(df)
+    print(f"Saved items to {item_store.DEFAULT_STORE_DIR} partitions: {written}")
@@ -1,66 +1,217 @@
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
-import shutil
 from dotenv import load_dotenv
 import sys
+import time
 
-def download_s3_files(bucket_name, folder_path, local_path, profile_name):
+import metrics
+
+# Records the ETag of every downloaded object, per local folder
+MANIFEST_FILE = ".s3_manifest.json"
+DEFAULT_WORKERS = 8
+
+
+def split_bucket_name(bucket_name):
     """
-    Download files from an S3 bucket using AWS CLI.
+    Split BUCKET_NAME into bucket and key prefix.
+
+    e.g. "auto-mail-sendgrid-tracking/production" -> ("auto-mail-sendgrid-tracking", "production/")
+    """
+    bucket, _, prefix = bucket_name.partition("/")
+    prefix = prefix.strip("/")
+    return bucket, f"{prefix}/" if prefix else ""
+
+
+def list_s3_objects(client, bucket, prefix):
+    """List every object under a prefix as {key: {"Size": ..., "ETag": ...}}."""
+    objects = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        metrics.count("s3.list_pages")
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            objects[obj["Key"]] = {"Size": obj["Size"], "ETag": obj["ETag"].strip('"')}
+    return objects
+
+
+def load_manifest(local_path):
+    path = os.path.join(local_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(local_path, manifest):
+    os.makedirs(local_path, exist_ok=True)
+    with open(os.path.join(local_path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
 
-    :param bucket_name: The name of the S3 bucket.
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def is_up_to_date(file_path, obj, manifest_etag):
+    """Local copy matches the object: same size, and same ETag (from the manifest or the file's MD5)."""
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != obj["Size"]:
+        return False
+    if manifest_etag is not None:
+        return manifest_etag == obj["ETag"]
+    # Multipart ETags are not an MD5 of the content; size has to do
+    if "-" in obj["ETag"]:
+        return True
+    return file_md5(file_path) == obj["ETag"]
+
+
+def download_s3_files(bucket_name, folder_path, local_path, profile_name, max_workers=DEFAULT_WORKERS,
+                      objects=None):
+    """
+    Sync files from an S3 bucket folder to a local directory using boto3.
+
+    Objects whose size and ETag match the local copy are skipped, local files no
+    longer in S3 are removed, and the rest are downloaded on a thread pool.
+
+    :param bucket_name: The name of the S3 bucket, optionally followed by "/key-prefix".
     :param folder_path: The folder path in the S3 bucket to download files from.
     :param local_path: The local directory to download files to.
-    :param profile_name: The AWS CLI profile name to use for authentication.
+    :param profile_name: The AWS profile name to use for authentication.
+    :param max_workers: Number of concurrent downloads.
+    :param objects: The folder's listing ({key: {"Size": ..., "ETag": ...}}) if already
+        fetched; listed here otherwise.
+    :return: Dict with counts of downloaded, skipped and deleted files.
+    :raises RuntimeError: If any object failed to download.
     """
-    try:
+    import boto3
+
+    # Add profile only if specified (not needed in GitHub Actions)
+    session = boto3.Session(profile_name=profile_name) if profile_name else boto3.Session()
+    client = session.client("s3")
+
+    bucket, base_prefix = split_bucket_name(bucket_name)
+    prefix = f"{base_prefix}{folder_path}"
+    if objects is None:
+        objects = list_s3_objects(client, bucket, prefix)
+    manifest = load_manifest(local_path)
+
+    to_download = []
+    wanted = set()
+    for key, obj in objects.items():
+        relative = key[len(prefix):]
+        file_path = os.path.join(local_path, relative)
+        wanted.add(os.path.normpath(file_path))
+        if not is_up_to_date(file_path, obj, manifest.get(relative)):
+            to_download.append((key, relative, file_path))
+        else:
+            manifest[relative] = obj["ETag"]
+
+    # Remove local files that are no longer in S3
+    deleted = 0
+    if os.path.exists(local_path):
+        for root, _, files in os.walk(local_path):
+            for name in files:
+                file_path = os.path.normpath(os.path.join(root, name))
+                if name != MANIFEST_FILE and file_path not in wanted:
+                    os.remove(file_path)
+                    manifest.pop(os.path.relpath(file_path, local_path), None)
+                    deleted += 1
+
+    def download(task):
+        key, relative, file_path = task
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        tmp_path = f"{file_path}.part"
+        start = time.perf_counter()
+        client.download_file(bucket, key, tmp_path)
+        metrics.observe("s3.download_file", time.perf_counter() - start)
+        os.replace(tmp_path, file_path)
+        return relative
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download, task): task for task in to_download}
+        for future, (key, relative, _) in futures.items():
+            try:
+                future.result()
+                manifest[relative] = objects[key]["ETag"]
+                metrics.count("s3.objects_downloaded")
+                metrics.count("s3.bytes_downloaded", objects[key]["Size"])
+            except Exception as e:
+                print(f"Error downloading s3://{bucket}/{key}: {e}")
+                failed.append(key)
+
+    save_manifest(local_path, manifest)
+    metrics.count("s3.objects_skipped", len(objects) - len(to_download))
+    summary = {
+        "downloaded": len(to_download) - len(failed),
+        "skipped": len(objects) - len(to_download),
+        "deleted": deleted,
+    }
+    print(f"Synced s3://{bucket}/{prefix} -> {local_path}: {summary}")
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(objects)} objects failed to download from s3://{bucket}/{prefix}")
+    return summary
+
+
+def list_events_for_date(bucket_name, profile_name, year, month, day):
+    """
+    List the day's SendGrid event objects without downloading them.
+
+    :return: {key: {"Size": ..., "ETag": ...}} for the day's partition.
+    """
+    import boto3
+
+    session = boto3.Session(profile_name=profile_name) if profile_name else boto3.Session()
+    client = session.client("s3")
+    bucket, base_prefix = split_bucket_name(bucket_name)
+    return list_s3_objects(client, bucket, f"{base_prefix}email-events/year={year}/month={month}/day={day}/")
+
+
+def download_events_for_date(bucket_name, profile_name, year, month, day, max_workers=DEFAULT_WORKERS,
+                             objects=None):
+    """
+    Download the SendGrid event partition for one day.
+
+    Pass objects (from list_events_for_date) to reuse a listing instead of listing again.
+
+    :return: The local directory holding the day's parquet files.
+    """
+    folder_path = f'email-events/year={year}/month={month}/day={day}/'
+    local_path = f'email-events/year={year}/month={month}/day={day}'
+
+    download_s3_files(bucket_name, folder_path, local_path, profile_name, max_workers, objects)
+    return local_path
 
-        # Delete folders v1 and v2 if they exist
-        if os.path.exists(local_path):
-            shutil.rmtree(local_path)
-            print(f"Deleted folder: {local_path}")
-
-        command = [
-            "aws", "s3", "cp",
-            f"s3://{bucket_name}/{folder_path}",
-            folder_path,
-            "--recursive",
-        ]
-        
-        # Add profile only if specified (not needed in GitHub Actions)
-        if profile_name:
-            command.extend(["--profile", profile_name])
-
-        print(f"Executing command: {' '.join(command)}")
-        result = subprocess.run(command, check=True, text=True, capture_output=True)
-        print("Download successful.")
-        print(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print("Error during download:")
-        print(e.stderr)
 
 # Example usage:
-os.environ.pop('FULL_DAY', None)
-os.environ.pop('FULL_MONTH', None)
-os.environ.pop('FULL_YEAR', None)
-load_dotenv()
-bucket_name = os.getenv('BUCKET_NAME')
-# day = os.getenv('FULL_DAY')
-# month = os.getenv('FULL_MONTH')
-# year = os.getenv('FULL_YEAR')
-
-if len(sys.argv) >= 4:
-    year = sys.argv[1]
-    month = sys.argv[2]
-    day = sys.argv[3]
-else:
-    year = os.getenv('FULL_YEAR')
-    month = os.getenv('FULL_MONTH')
-    day = os.getenv('FULL_DAY')
-
-profile_name = os.getenv('AWS_PROFILE')
-
-folder_path = f'email-events/year={year}/month={month}/day={day}/'
-local_path = f'email-events/year={year}/month={month}/day={day}'
-
-download_s3_files(bucket_name, folder_path, local_path, profile_name)
+if __name__ == "__main__":
+    os.environ.pop('FULL_DAY', None)
+    os.environ.pop('FULL_MONTH', None)
+    os.environ.pop('FULL_YEAR', None)
+    load_dotenv()
+    bucket_name = os.getenv('BUCKET_NAME')
+
+    if len(sys.argv) >= 4:
+        year = sys.argv[1]
+        month = sys.argv[2]
+        day = sys.argv[3]
+    else:
+        year = os.getenv('FULL_YEAR')
+        month = os.getenv('FULL_MONTH')
+        day = os.getenv('FULL_DAY')
+
+    profile_name = os.getenv('AWS_PROFILE')
+    max_workers = int(os.getenv('S3_DOWNLOAD_WORKERS', DEFAULT_WORKERS))
+
+    try:
+        download_events_for_date(bucket_name, profile_name, year, month, day, max_workers)
+    except Exception as e:
+        print(f"Error during download: {e}")
+        sys.exit(1)
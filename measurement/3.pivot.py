@@ -1,19 +1,66 @@
-import csv
 import os
 from dotenv import load_dotenv
 import pandas as pd
-from datetime import datetime, timezone, timedelta
-from google_sheet_utils import update_google_sheet
+from schemas import (
+    BEAUTIFIED_ITEM_SCHEMA, EVENT_SCHEMA, REQUEST_SCHEMA, conform_table, read_parquet, to_frame, to_pandas,
+    write_parquet
+)
+from time_utils import format_japan_time, on_japan_date, to_jst
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
 import sys
 
-# Define a function to convert timestamp to Japan datetime format
-def convert_to_japan_time(timestamp):
-    if pd.isna(timestamp):
-        return None
-    dt = datetime.fromtimestamp(int(timestamp), tz=timezone.utc)
-    japan_time = dt.astimezone(timezone(timedelta(hours=9)))
-    return japan_time.strftime("%Y-%m-%d %H:%M:%S")
+EVENT_NAMES = [
+    "processed",
+    "dropped",
+    "deferred",
+    "bounce",
+    "delivered",
+    "open",
+    "click",
+    "spamreport",
+]
+
+# Item column -> request column
+ITEM_COLUMNS = {
+    "request_id": "request_id",
+    "request_status": "lambda_email_status",
+    "sent_at_jp": "lambda_sent_at",
+    "answer": "answer",
+    "submitted_at_jp": "answered_at",
+    "sms_status": "lambda_sms_status",
+    "total_price": "total_price",
+    "reason_cancel": "cancel_reason",
+}
+
+# Event fields pivot_events reads; events are loaded with only these
+EVENT_READ_COLUMNS = EVENT_SCHEMA.names
+
+EVENT_COLUMNS = ["sg_template_name"] + [f"{event_name}_at" for event_name in EVENT_NAMES]
+
+# Sheet column order (A..Q)
+SHEET_COLUMNS = [
+    "request_id",
+    "lambda_email_status",
+    "lambda_sent_at",
+    "answer",
+    "answered_at",
+    "lambda_sms_status",
+    "total_price",
+    "sg_template_name",
+    "processed_at",
+    "dropped_at",
+    "deferred_at",
+    "bounce_at",
+    "delivered_at",
+    "open_at",
+    "click_at",
+    "spamreport_at",
+    "cancel_reason",
+]
 
 
 def save_to_csv(data, file_path):
@@ -24,220 +71,343 @@ def save_to_csv(data, file_path):
     df.to_csv(file_path, index=False)
 
 
-# Select request from items.
-def select_request_from_items(csv_filepath, year, month, day):
-    requests = []
-    df = pd.read_csv(csv_filepath)
-    for _, row in df.iterrows():
-        flow_assessment_jp = row.get("flow_assessment_jp")
-        if isinstance(flow_assessment_jp, str) and flow_assessment_jp.startswith(
-            f"{year}-{month}-{day}"
-        ):
-            request_id = row.get("request_id")
-            lambda_email_status = row.get("request_status")
-            lambda_sent_at = row.get("sent_at_jp")
-            answer = row.get("answer")
-            submitted_at = row.get("submitted_at_jp")
-            lambda_sms_status = row.get("sms_status")
-            total_price = row.get("total_price")
-            cancel_reason = row.get("reason_cancel")
-            requests.append(
-                {
-                    "request_id": request_id,
-                    "lambda_email_status": lambda_email_status,
-                    "lambda_sent_at": lambda_sent_at,
-                    "answer": answer,
-                    "answered_at": submitted_at,
-                    "lambda_sms_status": lambda_sms_status,
-                    "total_price": total_price,
-                    "cancel_reason": cancel_reason
-                }
-            )
-    return requests
-
-
-# Merge all parquet files into one CSV file
-def merge_parquet_files_to_csv(parquet_dir, csv_filepath):
+def requests_path(year, month, day):
+    return f"requests/{year}{month}/requests_{year}{month}{day}.parquet"
+
+
+def load_requests(year, month, day):
+    """Read back a request table written by save_requests (empty if there is none)."""
+    return read_parquet(requests_path(year, month, day), REQUEST_SCHEMA)
+
+
+def save_requests(requests, year, month, day, export_csv=False):
+    """
+    Save the day's request table as Parquet, plus a CSV copy when export_csv is set.
+
+    Returns:
+        list of str: The files written.
+    """
+    output_filepath = requests_path(year, month, day)
+    write_parquet(requests, output_filepath, REQUEST_SCHEMA)
+    written = [output_filepath]
+    if export_csv:
+        csv_filepath = f"requests/{year}{month}/requests_{year}{month}{day}.csv"
+        save_to_csv(render_requests(requests), csv_filepath)
+        written.append(csv_filepath)
+    return written
+
+
+# Select the day's requests (flow_assessment on that JST date) from the beautified items.
+def select_request_from_items(df, year, month, day):
+    columns = list(ITEM_COLUMNS.values())
+    if df.empty or "flow_assessment_jp" not in df.columns:
+        return pd.DataFrame(columns=columns)
+
+    is_day = on_japan_date(df["flow_assessment_jp"], year, month, day)
+    requests = df.loc[is_day].reindex(columns=list(ITEM_COLUMNS)).rename(columns=ITEM_COLUMNS)
+    return requests.reset_index(drop=True)
+
+
+# Merge all parquet files of a day into one DataFrame
+def load_merged_events(parquet_dir, batch_rows=None):
     # Check if directory exists
     if not os.path.exists(parquet_dir):
         print(f"[WARNING] Directory not found: {parquet_dir}")
-        os.makedirs(os.path.dirname(csv_filepath), exist_ok=True)
-        pd.DataFrame().to_csv(csv_filepath, index=False)
-        return
-    
+        return pd.DataFrame()
+
     all_files = [
         f"{parquet_dir}/{f}" for f in os.listdir(parquet_dir) if f.endswith(".parquet")
     ]
-    
+
     # Handle empty directory
     if not all_files:
         print(f"[WARNING] No parquet files found in: {parquet_dir}")
-        os.makedirs(os.path.dirname(csv_filepath), exist_ok=True)
-        pd.DataFrame().to_csv(csv_filepath, index=False)
-        return
-    
-    df = pd.concat([pd.read_parquet(f) for f in all_files], ignore_index=True)
+        return pd.DataFrame()
+
+    # Reduce the files batch by batch instead of concatenating them
+    if batch_rows:
+        return aggregate_event_batches(
+            batch
+            for f in all_files
+            for batch in iter_file_batches(pq.ParquetFile(f), batch_rows)
+        )
+
+    tables = [conform_table(pq.read_table(f, columns=event_columns(pq.read_schema(f))), EVENT_SCHEMA)
+              for f in all_files]
+    return to_pandas(pa.concat_tables(tables))
+
+
+def event_columns(schema):
+    return [name for name in EVENT_READ_COLUMNS if name in schema.names]
 
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(csv_filepath), exist_ok=True)
-    df.to_csv(csv_filepath, index=False)
 
+def iter_file_batches(parquet_file, batch_rows):
+    yield from parquet_file.iter_batches(batch_size=batch_rows, columns=event_columns(parquet_file.schema_arrow))
+
+
+# Read one day of the Hive-partitioned event dataset straight from S3 (or any pyarrow filesystem)
+def load_events_from_dataset(events_uri, year, month, day, filesystem=None, batch_rows=None):
+    """
+    Read a day of SendGrid events from the year=/month=/day= dataset without a local copy.
+
+    Args:
+        events_uri: Dataset root, e.g. "s3://bucket/production/email-events" or a local directory.
+        filesystem: pyarrow filesystem to read from; inferred from events_uri when None.
+        batch_rows: Read record batches of this many rows and keep only the
+            first event per (request_id, event) (see aggregate_event_batches).
+
+    Returns:
+        DataFrame of the day's events (EVENT_SCHEMA columns).
+    """
+    partition_fields = ["year", "month", "day"]
+    partitioning = ds.partitioning(
+        pa.schema([(name, pa.string()) for name in partition_fields]), flavor="hive"
+    )
+
+    if filesystem is None:
+        filesystem, root = pafs.FileSystem.from_uri(events_uri)
+    else:
+        root = events_uri
+    root = root.rstrip("/")
+    # Only list the day's prefix; the filter prunes by partition value
+    day_dir = f"{root}/year={year}/month={month}/day={day}"
 
-# Select request has request_id and event exists in merged events.
-def select_request_with_event(requests, event_filepath, event_name):
     try:
-        df = pd.read_csv(event_filepath)
-    except Exception as e:
-        print(f"[WARNING] Failed to read events file: {e}")
-        for request in requests:
-            request[f"{event_name}_at"] = None
-        return requests
-    
-    if df.empty:
-        for request in requests:
-            request[f"{event_name}_at"] = None
-        return requests
-    
-    events = df[df["event"] == event_name]
-    request_ids = events["request_id"].unique()
-    event_dict = events.set_index("request_id")["timestamp"].to_dict()
-
-    for request in requests:
-        if request["request_id"] in request_ids:
-            timestamp = event_dict[request["request_id"]]
-            request[f"{event_name}_at"] = convert_to_japan_time(timestamp)
-
-        else:
-            request[f"{event_name}_at"] = None
-
-    return requests
-
-
-def select_request_with_sg(requests, event_filepath):
+        dataset = ds.dataset(
+            day_dir,
+            format="parquet",
+            filesystem=filesystem,
+            partitioning=partitioning,
+            partition_base_dir=root,
+        )
+    except (FileNotFoundError, OSError) as e:
+        print(f"[WARNING] No events found at {day_dir}: {e}")
+        return pd.DataFrame()
+
+    day_filter = (
+        (ds.field("year") == year) & (ds.field("month") == month) & (ds.field("day") == day)
+    )
+    columns = event_columns(dataset.schema)
+    if batch_rows:
+        return aggregate_event_batches(
+            dataset.to_batches(filter=day_filter, columns=columns, batch_size=batch_rows)
+        )
+    table = dataset.to_table(filter=day_filter, columns=columns)
+    if table.num_rows == 0:
+        print(f"[WARNING] No events found at {day_dir}")
+    return to_pandas(conform_table(table, EVENT_SCHEMA))
+
+
+def list_event_files(events_uri, year, month, day, filesystem=None):
+    """
+    List the day's event files in the dataset as {path: {"Size": ..., "Mtime": ...}}.
+
+    Used to fingerprint the day's events when they are streamed rather than synced.
+    """
+    if filesystem is None:
+        filesystem, root = pafs.FileSystem.from_uri(events_uri)
+    else:
+        root = events_uri
+    day_dir = f"{root.rstrip('/')}/year={year}/month={month}/day={day}"
+    selector = pafs.FileSelector(day_dir, recursive=True, allow_not_found=True)
+    return {
+        info.path: {"Size": info.size, "Mtime": info.mtime_ns}
+        for info in filesystem.get_file_info(selector)
+        if info.type == pafs.FileType.File
+    }
+
+
+# Merge all parquet files of a day into one compressed Parquet file
+def merge_parquet_files(parquet_dir, parquet_filepath):
+    df = load_merged_events(parquet_dir)
+    write_parquet(df, parquet_filepath, EVENT_SCHEMA)
+
+
+def first_events(df):
+    """
+    Keep the earliest row per (request_id, event) of the known event types.
+
+    Returns:
+        DataFrame with EVENT_READ_COLUMNS, request_id as str.
+    """
+    if df.empty or not {"request_id", "event", "timestamp"}.issubset(df.columns):
+        return pd.DataFrame(columns=EVENT_READ_COLUMNS)
+
+    events = df[df["event"].isin(EVENT_NAMES)].copy()
+    events["request_id"] = events["request_id"].astype(str)
+    if "sg_template_name" not in events.columns:
+        events["sg_template_name"] = None
+    events = events.sort_values(["request_id", "event", "timestamp"], kind="mergesort")
+    return events.drop_duplicates(subset=["request_id", "event"], keep="first")[EVENT_READ_COLUMNS]
+
+
+def aggregate_event_batches(batches):
+    """
+    Reduce record batches of events to first_events() one batch at a time.
+
+    Only the running aggregate (at most one row per request and event type) and
+    the current batch are in memory, and the result pivots exactly like the
+    full day would: ties keep the earlier batch's row, as the stable sort does.
+    """
+    aggregate = None
+    for batch in batches:
+        reduced = first_events(to_pandas(conform_table(pa.Table.from_batches([batch]), EVENT_SCHEMA)))
+        if aggregate is None:
+            aggregate = reduced
+        elif not reduced.empty:
+            aggregate = first_events(pd.concat([aggregate, reduced], ignore_index=True))
+    if aggregate is None:
+        return pd.DataFrame(columns=EVENT_READ_COLUMNS)
+    # Batches with different categories concatenate to plain strings; re-encode
+    return to_frame(aggregate, EVENT_SCHEMA)
+
+
+# Pivot the day's events into one row per request_id.
+def pivot_events(df):
+    """
+    Turn the merged events into sg_template_name plus one "<event>_at" column per event type.
+
+    Duplicate events resolve to the earliest timestamp per (request_id, event);
+    sg_template_name comes from that "processed" event.
+
+    Returns:
+        DataFrame indexed by request_id (as str) with EVENT_COLUMNS.
+    """
+    if df.empty or not {"request_id", "event", "timestamp"}.issubset(df.columns):
+        return pd.DataFrame(columns=EVENT_COLUMNS, index=pd.Index([], name="request_id"))
+
+    first = first_events(df)
+
+    timestamps = first.pivot(index="request_id", columns="event", values="timestamp")
+    timestamps = timestamps.reindex(columns=EVENT_NAMES)
+    pivoted = pd.DataFrame(
+        {f"{event_name}_at": to_jst(timestamps[event_name]) for event_name in EVENT_NAMES},
+        index=timestamps.index,
+    )
+
+    processed = first[first["event"] == "processed"].set_index("request_id")
+    pivoted.insert(0, "sg_template_name", processed["sg_template_name"].reindex(pivoted.index))
+    return pivoted
+
+
+def build_requests(items_df, events_df, year, month, day):
+    """
+    Build the day's request rows by left-joining the pivoted events onto the day's requests.
+
+    Rows are sorted by request_id, so the sheet rows keep their order however
+    the items were fetched (parallel scan segments finish in any order).
+
+    Returns:
+        DataFrame with the request columns, sg_template_name and one "<event>_at" column per event.
+    """
+    requests = select_request_from_items(items_df, year, month, day)
+    requests = requests.sort_values("request_id", kind="mergesort").reset_index(drop=True)
+    pivoted = pivot_events(events_df)
+
+    keys = requests["request_id"].astype(str)
+    joined = pivoted.reindex(keys).reset_index(drop=True)
+    return pd.concat([requests, joined], axis=1)
+
+
+def render_requests(requests):
+    """
+    String rendering of a request table for the Sheets and CSV output.
+
+    JST datetimes become 'YYYY-MM-DD HH:MM:SS' and empty cells become None;
+    everything before this keeps the compact dtypes of REQUEST_SCHEMA.
+    """
+    rendered = pd.DataFrame(requests).copy()
+    for column in rendered.columns:
+        if isinstance(rendered[column].dtype, pd.DatetimeTZDtype):
+            rendered[column] = format_japan_time(rendered[column])
+    return rendered.astype(object).replace({np.nan: None})
+
+
+def requests_to_rows(requests):
+    """Sheet rows (columns A..Q) for a request table, with "" for empty cells."""
+    # Keep the sheet columns in A..Q order
+    rows = render_requests(pd.DataFrame(requests, columns=SHEET_COLUMNS)).values.tolist()
+    # values.batchUpdate skips nulls, so an emptied cell must be written as ""
+    return [["" if value is None else value for value in row] for row in rows]
+
+
+def upload_requests(requests, sheet_id, sheet_name, creds_file="service_account.json", diff=False):
+    """
+    Write the request rows to the day's tab as one A2:Q{n} block.
+
+    With diff set, only rows that differ from the last upload are written.
+    """
+    # gspread is only loaded when uploading (not for the local backend)
+    from google_sheet_utils import SNAPSHOT_DIR, update_google_sheet_rows
+
+    update_google_sheet_rows(
+        sheet_id, sheet_name, requests_to_rows(requests), creds_file, diff=diff, snapshot_dir=SNAPSHOT_DIR
+    )
+
+
+def upload_request_tabs(tables, sheet_id, creds_file="service_account.json", diff=False):
+    """
+    Write several days' request tables to their tabs in batched values.batchUpdate calls.
+
+    Args:
+        tables: Dict mapping tab name (the day, e.g. "05") to its request table.
+        diff: Write only the rows that differ from the last upload.
+
+    Returns:
+        int: Number of API calls made.
+    """
+    from google_sheet_utils import SNAPSHOT_DIR, update_google_sheet_tabs
+
+    tab_rows = {sheet_name: requests_to_rows(requests) for sheet_name, requests in tables.items()}
+    return update_google_sheet_tabs(sheet_id, tab_rows, creds_file, diff=diff, snapshot_dir=SNAPSHOT_DIR)
+
+
+if __name__ == "__main__":
+    os.environ.pop("FULL_MONTH", None)
+    os.environ.pop("FULL_YEAR", None)
+    os.environ.pop("FULL_DAY", None)
+    os.environ.pop("SHEET_ID", None)
+    load_dotenv()
+
+    if len(sys.argv) >= 5:
+        year = sys.argv[1]
+        month = sys.argv[2]
+        day = sys.argv[3]
+        sheet_id = sys.argv[4]
+    else:
+        year = os.getenv('FULL_YEAR')
+        month = os.getenv('FULL_MONTH')
+        day = os.getenv('FULL_DAY')
+        sheet_id = os.getenv('SHEET_ID')
+
+    export_csv = os.getenv("EXPORT_CSV", "").lower() in ("1", "true", "yes")
+    diff_sheets = os.getenv("DIFF_SHEETS", "").lower() in ("1", "true", "yes")
+
+    items_filepath = f"data/{year}{month}/items_with_japan_time_{year}{month}{day}.parquet"
     try:
-        df = pd.read_csv(event_filepath)
+        items_df = read_parquet(items_filepath, BEAUTIFIED_ITEM_SCHEMA)
     except Exception as e:
-        print(f"[WARNING] Failed to read events file for sg: {e}")
-        for request in requests:
-            request["sg_template_name"] = None
-        return requests
-    
-    if df.empty:
-        for request in requests:
-            request["sg_template_name"] = None
-        return requests
-    
-    events = df[df["event"] == "processed"]
-    request_ids = events["request_id"].unique()
-    template_dict = events.set_index("request_id")["sg_template_name"].to_dict()
-
-    for request in requests:
-        if request["request_id"] in request_ids:
-            request["sg_template_name"] = template_dict[request["request_id"]]
-
-        else:
-            request["sg_template_name"] = None
-
-    return requests
-
-
-os.environ.pop("FULL_MONTH", None)
-os.environ.pop("FULL_YEAR", None)
-os.environ.pop("FULL_DAY", None)
-os.environ.pop("SHEET_ID", None)
-load_dotenv()
-# month = os.getenv("FULL_MONTH")
-# year = os.getenv("FULL_YEAR")
-# day = os.getenv("FULL_DAY")
-
-if len(sys.argv) >= 5:
-    year = sys.argv[1]
-    month = sys.argv[2]
-    day = sys.argv[3]
-    sheet_id = sys.argv[4]
-else:
-    year = os.getenv('FULL_YEAR')
-    month = os.getenv('FULL_MONTH')
-    day = os.getenv('FULL_DAY')
-    sheet_id = os.getenv('SHEET_ID')
-
-csv_filepath = f"data/{year}{month}/items_with_japan_time_{year}{month}{day}.csv"
-requests = select_request_from_items(csv_filepath, year, month, day)
-
-email_event_dir = f"email-events/year={year}/month={month}/day={day}"
-event_filepath = f"events/merged_events_{year}{month}{day}.csv"
-merge_parquet_files_to_csv(email_event_dir, event_filepath)
-
-print(f"Merged events saved to {event_filepath}")
-
-requests_with_sg = select_request_with_sg(requests, event_filepath)
-
-requests_with_processed = select_request_with_event(
-    requests, event_filepath, "processed"
-)
-requests_with_dropped = select_request_with_event(requests, event_filepath, "dropped")
-requests_with_deferred = select_request_with_event(requests, event_filepath, "deferred")
-requests_with_bounce = select_request_with_event(requests, event_filepath, "bounce")
-requests_with_delivered = select_request_with_event(
-    requests, event_filepath, "delivered"
-)
-requests_with_open = select_request_with_event(requests, event_filepath, "open")
-requests_with_click = select_request_with_event(requests, event_filepath, "click")
-requests_with_spamreport = select_request_with_event(
-    requests, event_filepath, "spamreport"
-)
+        print(f"[WARNING] Failed to read {items_filepath}: {e}")
+        items_df = pd.DataFrame()
 
-# Save final requests
-output_filepath = f"requests/{year}{month}/requests_{year}{month}{day}.csv"
-save_to_csv(requests, output_filepath)
-
-print(f"Writing requests to {output_filepath}")
-
-# Convert list to a DataFrame
-requests_df = pd.DataFrame(requests)
-requests_df = requests_df.replace({np.nan: None})
-
-# Update Google Sheets (sheet_id from command line or env)
-sheet_name = day
-range_names = [
-    f"A2:A{len(requests) + 1}",
-    f"B2:B{len(requests) + 1}",
-    f"C2:C{len(requests) + 1}",
-    f"D2:D{len(requests) + 1}",
-    f"E2:E{len(requests) + 1}",
-    f"F2:F{len(requests) + 1}",
-    f"G2:G{len(requests) + 1}",
-    f"H2:H{len(requests) + 1}",
-    f"I2:I{len(requests) + 1}",
-    f"J2:J{len(requests) + 1}",
-    f"K2:K{len(requests) + 1}",
-    f"L2:L{len(requests) + 1}",
-    f"M2:M{len(requests) + 1}",
-    f"N2:N{len(requests) + 1}",
-    f"O2:O{len(requests) + 1}",
-    f"P2:P{len(requests) + 1}",
-    f"Q2:Q{len(requests) + 1}",
-]
-values = [
-    requests_df[["request_id"]].values.tolist(),
-    requests_df[["lambda_email_status"]].values.tolist(),
-    requests_df[["lambda_sent_at"]].values.tolist(),
-    requests_df[["answer"]].values.tolist(),
-    requests_df[["answered_at"]].values.tolist(),
-    requests_df[["lambda_sms_status"]].values.tolist(),
-    requests_df[["total_price"]].values.tolist(),
-    requests_df[["sg_template_name"]].values.tolist(),
-    requests_df[["processed_at"]].values.tolist(),
-    requests_df[["dropped_at"]].values.tolist(),
-    requests_df[["deferred_at"]].values.tolist(),
-    requests_df[["bounce_at"]].values.tolist(),
-    requests_df[["delivered_at"]].values.tolist(),
-    requests_df[["open_at"]].values.tolist(),
-    requests_df[["click_at"]].values.tolist(),
-    requests_df[["spamreport_at"]].values.tolist(),
-    requests_df[["cancel_reason"]].values.tolist(),
-]
-creds_file = "service_account.json"
-update_google_sheet(sheet_id, sheet_name, range_names, values, creds_file)
+    email_event_dir = f"email-events/year={year}/month={month}/day={day}"
+    event_filepath = f"events/merged_events_{year}{month}{day}.parquet"
+    merge_parquet_files(email_event_dir, event_filepath)
+
+    print(f"Merged events saved to {event_filepath}")
+
+    requests = build_requests(items_df, read_parquet(event_filepath, EVENT_SCHEMA), year, month, day)
+
+    # Save final requests
+    for output_filepath in save_requests(requests, year, month, day, export_csv):
+        print(f"Writing requests to {output_filepath}")
+
+    # Update Google Sheets (sheet_id from command line or env)
+    sheet_name = day
+    try:
+        upload_requests(requests, sheet_id, sheet_name, diff=diff_sheets)
+    except Exception as e:
+        print(f"[ERROR] Failed to update Google Sheets for {year}-{month}-{day}: {e}")
+        sys.exit(1)
 
-print(f"Updated Google Sheets with data for {year}-{month}-{day} in sheet '{sheet_name}' - {sheet_id}")
+    print(f"Updated Google Sheets with data for {year}-{month}-{day} in sheet '{sheet_name}' - {sheet_id}")
@@ -2,13 +2,15 @@
 Auto-create Google Sheet for each month by cloning from template.
 Uses 30-day or 31-day template based on the month.
 Stores mapping in a Config Google Sheet for persistence across CI runs.
+
+gspread and the credentials are only needed once the Sheets API is called, so
+importing this module (and dry runs) stay fast and work without them.
 """
 import os
+import json
+import time
 import calendar
 from pathlib import Path
-import gspread
-from google.oauth2.service_account import Credentials
-from google_sheet_utils import clone_template_sheet
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,67 +23,116 @@ CREDS_FILE = Path(__file__).parent / "service_account.json"
 # Sheet "sheets": month_key, sheet_id
 CONFIG_SHEET_ID = os.getenv("CONFIG_SHEET_ID", "")
 
-# Validate credentials file exists
-if not CREDS_FILE.exists():
-    raise FileNotFoundError(
-        f"Credentials file not found: {CREDS_FILE}\n"
-        "For local: Place service_account.json in project root.\n"
-        "For GitHub Actions: Set GOOGLE_SERVICE_ACCOUNT secret (base64 encoded)."
-    )
-
-
-def get_gspread_client():
-    """Get authenticated gspread client."""
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    creds = Credentials.from_service_account_file(str(CREDS_FILE), scopes=scope)
-    return gspread.authorize(creds)
+# Local copy of the config sheet mapping, so looking up a month's sheet costs
+# no API calls while the copy is younger than the TTL. A month missing from the
+# copy always triggers a fresh read before a new sheet is cloned.
+MAPPING_CACHE_FILE = Path("data/sheet_mapping.json")
+MAPPING_CACHE_TTL_SECONDS = int(os.getenv("SHEET_MAPPING_TTL_SECONDS", str(24 * 3600)))
+
+_mapping_cache = None
+
+
+def check_credentials() -> None:
+    """Raise FileNotFoundError if the service account file is missing."""
+    if not CREDS_FILE.exists():
+        raise FileNotFoundError(
+            f"Credentials file not found: {CREDS_FILE}\n"
+            "For local: Place service_account.json in project root.\n"
+            "For GitHub Actions: Set GOOGLE_SERVICE_ACCOUNT secret (base64 encoded)."
+        )
+
+
+def fetch_mapping_from_sheet() -> dict:
+    """Read the templates and sheets worksheets of the config sheet (raises on error)."""
+    from google_sheet_utils import get_worksheet
+    from sheets_writer import call_with_retry, read_bucket
+    check_credentials()
+    # Load templates from "templates" worksheet
+    templates_ws = get_worksheet(CONFIG_SHEET_ID, "templates", CREDS_FILE)
+    templates_data = call_with_retry(templates_ws.get_all_records, bucket=read_bucket)
+    templates = {row["type"]: row["sheet_id"] for row in templates_data}
+    
+    # Load sheets from "sheets" worksheet
+    sheets_ws = get_worksheet(CONFIG_SHEET_ID, "sheets", CREDS_FILE)
+    sheets_data = call_with_retry(sheets_ws.get_all_records, bucket=read_bucket)
+    # Convert month_key to string (Google Sheets may return as int)
+    sheets = {str(row["month_key"]): row["sheet_id"] for row in sheets_data}
+    
+    return {"templates": templates, "sheets": sheets}
 
 
 def load_mapping_from_sheet() -> dict:
-    """Load sheets mapping from Google Sheet."""
+    """Load sheets mapping from Google Sheet and refresh the local cache."""
     try:
-        client = get_gspread_client()
-        config_sheet = client.open_by_key(CONFIG_SHEET_ID)
-        
-        # Load templates from "templates" worksheet
-        templates_ws = config_sheet.worksheet("templates")
-        templates_data = templates_ws.get_all_records()
-        templates = {row["type"]: row["sheet_id"] for row in templates_data}
-        
-        # Load sheets from "sheets" worksheet
-        sheets_ws = config_sheet.worksheet("sheets")
-        sheets_data = sheets_ws.get_all_records()
-        # Convert month_key to string (Google Sheets may return as int)
-        sheets = {str(row["month_key"]): row["sheet_id"] for row in sheets_data}
-        
-        return {"templates": templates, "sheets": sheets}
+        mapping = fetch_mapping_from_sheet()
     except Exception as e:
         print(f"[WARNING] Failed to load mapping from sheet: {e}")
         return {"templates": {}, "sheets": {}}
+    write_mapping_cache(mapping)
+    return mapping
+
+
+def read_mapping_cache(max_age: float = None):
+    """Return the cached mapping if it is younger than max_age seconds, else None."""
+    global _mapping_cache
+    max_age = MAPPING_CACHE_TTL_SECONDS if max_age is None else max_age
+    cache = _mapping_cache
+    if cache is None and MAPPING_CACHE_FILE.exists():
+        try:
+            cache = json.loads(MAPPING_CACHE_FILE.read_text())
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] Ignoring unreadable mapping cache {MAPPING_CACHE_FILE}: {e}")
+            return None
+        _mapping_cache = cache
+    if cache is None or time.time() - cache.get("fetched_at", 0) > max_age:
+        return None
+    return {"templates": cache["templates"], "sheets": cache["sheets"]}
+
+
+def write_mapping_cache(mapping: dict, fetched_at: float = None) -> None:
+    """Store the mapping in memory and in MAPPING_CACHE_FILE."""
+    global _mapping_cache
+    _mapping_cache = {
+        "fetched_at": time.time() if fetched_at is None else fetched_at,
+        "templates": dict(mapping.get("templates", {})),
+        "sheets": dict(mapping.get("sheets", {})),
+    }
+    try:
+        MAPPING_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = MAPPING_CACHE_FILE.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(_mapping_cache, indent=2))
+        os.replace(tmp_path, MAPPING_CACHE_FILE)
+    except OSError as e:
+        print(f"[WARNING] Failed to write mapping cache {MAPPING_CACHE_FILE}: {e}")
+
+
+def invalidate_mapping_cache() -> None:
+    """Drop the cached mapping so the next lookup reads the config sheet."""
+    global _mapping_cache
+    _mapping_cache = None
+    MAPPING_CACHE_FILE.unlink(missing_ok=True)
 
 
 def save_sheet_mapping(month_key: str, sheet_id: str) -> None:
-    """Save a single sheet mapping to Google Sheet."""
+    """Save a single sheet mapping to Google Sheet and to the local cache."""
+    mapping = read_mapping_cache()
+    if mapping is not None and month_key in mapping["sheets"]:
+        print(f"[INFO] Mapping for {month_key} already exists, skipping save")
+        return
     try:
-        client = get_gspread_client()
-        config_sheet = client.open_by_key(CONFIG_SHEET_ID)
-        sheets_ws = config_sheet.worksheet("sheets")
-        
-        # Check if month_key already exists
-        existing_data = sheets_ws.get_all_records()
-        for row in existing_data:
-            if row.get("month_key") == month_key:
-                print(f"[INFO] Mapping for {month_key} already exists, skipping save")
-                return
-        
-        # Append new row
-        sheets_ws.append_row([month_key, sheet_id])
+        from google_sheet_utils import get_worksheet
+        from sheets_writer import call_with_retry, write_bucket
+        check_credentials()
+        sheets_ws = get_worksheet(CONFIG_SHEET_ID, "sheets", CREDS_FILE)
+        call_with_retry(sheets_ws.append_row, [month_key, sheet_id], bucket=write_bucket, idempotent=False)
         print(f"[INFO] Saved mapping: {month_key} -> {sheet_id}")
     except Exception as e:
         print(f"[ERROR] Failed to save mapping: {e}")
+        return
+    # Update the cached copy in place; the clone does not make it stale
+    if _mapping_cache is not None:
+        _mapping_cache["sheets"][month_key] = sheet_id
+        write_mapping_cache(_mapping_cache, _mapping_cache["fetched_at"])
 
 
 def get_template_id(year: int, month: int, templates: dict) -> str:
@@ -101,13 +152,26 @@ def get_or_create_monthly_sheet(year: str, month: str, dry_run: bool = False) ->
     Args:
         year: Year string (e.g., "2026")
         month: Month string (e.g., "01")
-        dry_run: If True, only print what would happen
+        dry_run: If True, only print what would happen. The Sheets API is not
+            called; the month is looked up in the local mapping cache only.
         
     Returns:
         Sheet ID for the specified month
     """
-    mapping = load_mapping_from_sheet()
     key = f"{year}{month}"
+    if dry_run:
+        # Any cached mapping will do, however old: a dry run makes no API calls
+        mapping = read_mapping_cache(max_age=float("inf"))
+        if mapping is not None and key in mapping["sheets"]:
+            print(f"[INFO] Sheet for {year}-{month} (cached): {mapping['sheets'][key]}")
+            return mapping["sheets"][key]
+        print(f"[DRY-RUN] Would look up or clone the sheet for {year}-{month} via the config sheet")
+        return f"dry-run-sheet-{key}"
+
+    mapping = read_mapping_cache()
+    if mapping is None or key not in mapping["sheets"]:
+        # Stale cache, or another run may have created the month since it was filled
+        mapping = load_mapping_from_sheet()
     
     # Check if sheet already exists
     if key in mapping.get("sheets", {}):
@@ -127,13 +191,10 @@ def get_or_create_monthly_sheet(year: str, month: str, dry_run: bool = False) ->
         load_dotenv()
         return os.getenv("SHEET_ID", "")
     
-    if dry_run:
-        print(f"[DRY-RUN] Would clone template ({days_in_month} days) for: {new_name}")
-        print(f"[DRY-RUN] Template ID: {template_id}")
-        return f"dry-run-sheet-{key}"
-    
     # Clone template
     print(f"[INFO] Creating new sheet for {year}-{month} ({days_in_month} days)...")
+    from google_sheet_utils import clone_template_sheet
+    check_credentials()
     new_sheet_id = clone_template_sheet(
         template_id=template_id,
         new_name=new_name,
@@ -154,8 +215,13 @@ if __name__ == "__main__":
     parser.add_argument("--year", required=True, help="Year (YYYY)")
     parser.add_argument("--month", required=True, help="Month (MM)")
     parser.add_argument("--dry-run", action="store_true", help="Print actions without executing")
+    parser.add_argument("--refresh-mapping", action="store_true",
+                        help="Ignore the local mapping cache and re-read the config sheet")
     
     args = parser.parse_args()
     
+    if args.refresh_mapping:
+        invalidate_mapping_cache()
+    
     sheet_id = get_or_create_monthly_sheet(args.year, args.month, args.dry_run)
     print(f"Sheet ID: {sheet_id}")
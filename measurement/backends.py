@@ -0,0 +1,207 @@
+"""
+Pluggable sources and sinks for the in-process pipeline.
+
+- Item source: DynamoDB (AWS), or a local Parquet snapshot. The snapshot is
+  either an item store directory (data/items/date=*/) or a single file.
+- Event source: the S3 bucket (synced or streamed), or a local
+  email-events/year=/month=/day= tree.
+- Report sink: the monthly Google Sheet, or local Parquet/CSV files.
+
+The "aws" backend is the normal production setup. The "local" backend lets a
+month be re-run against a local mirror without any AWS or Google calls.
+"""
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+import item_store
+import metrics
+from schemas import ITEM_SCHEMA, REQUEST_SCHEMA, read_parquet, write_parquet
+
+BACKENDS = ("aws", "local")
+REPORT_FORMATS = ("parquet", "csv")
+
+
+def load_stage(name):
+    # Imported here: pipeline imports this module
+    from pipeline import load_stage as load
+    return load(name)
+
+
+class DynamoDBItemSource:
+    """
+    Items from the DynamoDB table; every download is also upserted into the local item store.
+
+    With chunk_rows the scan is streamed into the store in batches of that many
+    items and days are read back from their partitions.
+    """
+
+    def __init__(self, config, chunk_rows=0):
+        self.config = config
+        self.chunk_rows = chunk_rows
+
+    def fetch_date(self, year, month, day):
+        config = self.config
+        if self.chunk_rows:
+            return self.fetch_range([(year, month, day)])[(year, month, day)]
+        items = load_stage("download_item").download_items_for_date(
+            config["table_name"], config["region_name"], year, month, day,
+            config["scan_segments"], config["index_name"], config["index_key"]
+        )
+        item_store.upsert_items(items)
+        return items
+
+    def fetch_range(self, dates, incremental=False, full_refresh=False):
+        config = self.config
+        download_item = load_stage("download_item")
+        if incremental:
+            download_item.sync_items_incremental(
+                config["table_name"], config["region_name"],
+                full_refresh=full_refresh, total_segments=config["scan_segments"],
+                batch_rows=self.chunk_rows
+            )
+            return item_store.PartitionView(dates)
+        return download_item.download_items_for_range(
+            config["table_name"], config["region_name"], dates, config["scan_segments"],
+            config["index_name"], config["index_key"], batch_rows=self.chunk_rows
+        )
+
+
+class LocalItemSource:
+    """Items from a local Parquet snapshot: an item store directory or a single .parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load_all(self):
+        return read_parquet(self.path, ITEM_SCHEMA)
+
+    def fetch_date(self, year, month, day):
+        return self.fetch_range([(year, month, day)])[(year, month, day)]
+
+    def fetch_range(self, dates, incremental=False, full_refresh=False):
+        if self.path.endswith(".parquet"):
+            return load_stage("download_item").split_items_by_day(self.load_all(), dates)
+        return item_store.PartitionView(dates, self.path)
+
+
+class S3EventSource:
+    """
+    SendGrid events from the bucket, synced to email-events/ or streamed with stream=True.
+
+    With chunk_rows the events are read in record batches of that many rows and
+    reduced to the first event per request and type as they are read.
+    """
+
+    def __init__(self, config, stream=False, chunk_rows=0):
+        self.config = config
+        self.stream = stream
+        self.chunk_rows = chunk_rows
+
+    def listing(self, year, month, day):
+        """The day's objects, used to fingerprint its events."""
+        if self.stream:
+            from pipeline import get_events_source
+            root, filesystem = get_events_source(self.config)
+            return load_stage("pivot").list_event_files(root, year, month, day, filesystem)
+        return load_stage("download_parquet").list_events_for_date(
+            self.config["bucket_name"], self.config["profile_name"], year, month, day
+        )
+
+    def load(self, year, month, day, listing=None):
+        pivot = load_stage("pivot")
+        if self.stream:
+            from pipeline import get_events_source
+            root, filesystem = get_events_source(self.config)
+            events = pivot.load_events_from_dataset(root, year, month, day, filesystem, self.chunk_rows)
+            if listing is not None:
+                metrics.count("s3.objects_streamed", len(listing))
+                metrics.count("s3.bytes_streamed", sum(obj["Size"] for obj in listing.values()))
+            return events
+        event_dir = load_stage("download_parquet").download_events_for_date(
+            self.config["bucket_name"], self.config["profile_name"], year, month, day, self.config["s3_workers"],
+            listing
+        )
+        return pivot.load_merged_events(event_dir, self.chunk_rows)
+
+
+class LocalEventSource:
+    """SendGrid events from a local year=/month=/day= tree (e.g. a synced email-events/)."""
+
+    def __init__(self, root, chunk_rows=0):
+        self.root = os.path.abspath(root)
+        self.chunk_rows = chunk_rows
+
+    def listing(self, year, month, day):
+        return load_stage("pivot").list_event_files(self.root, year, month, day)
+
+    def load(self, year, month, day, listing=None):
+        return load_stage("pivot").load_events_from_dataset(self.root, year, month, day, batch_rows=self.chunk_rows)
+
+
+class GoogleSheetsSink:
+    """Writes each day's request table to its tab of the monthly sheet."""
+
+    def __init__(self, sheet_id, diff=False):
+        self.sheet_id = sheet_id
+        self.diff = diff
+        self.target = sheet_id
+
+    def write_day(self, requests, year, month, day):
+        load_stage("pivot").upload_requests(requests, self.sheet_id, day, diff=self.diff)
+        return f"sheet '{day}' - {self.sheet_id}"
+
+    def write_days(self, tables):
+        """Write {(year, month, day): requests} in batched calls; returns the number of calls."""
+        return load_stage("pivot").upload_request_tabs(
+            {day: requests for (_, _, day), requests in tables.items()}, self.sheet_id, diff=self.diff
+        )
+
+
+class LocalReportSink:
+    """Writes each day's report (sheet columns A..Q) to <root>/YYYYMM/YYYYMMDD.parquet or .csv."""
+
+    def __init__(self, root, report_format="parquet"):
+        self.root = root
+        self.report_format = report_format
+        self.target = f"{os.path.abspath(root)}:{report_format}"
+
+    def report_path(self, year, month, day):
+        return os.path.join(self.root, f"{year}{month}", f"{year}{month}{day}.{self.report_format}")
+
+    def write_day(self, requests, year, month, day):
+        pivot = load_stage("pivot")
+        report = pd.DataFrame(requests, columns=pivot.SHEET_COLUMNS)
+        path = self.report_path(year, month, day)
+        if self.report_format == "csv":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pivot.render_requests(report).to_csv(path, index=False)
+        else:
+            # Typed columns (JST datetimes, categoricals); CSV gets the Sheets rendering
+            schema = pa.schema([REQUEST_SCHEMA.field(column) for column in pivot.SHEET_COLUMNS])
+            write_parquet(report, path, schema)
+        return path
+
+    def write_days(self, tables):
+        for (year, month, day), requests in tables.items():
+            self.write_day(requests, year, month, day)
+        return 0
+
+
+def get_item_source(options, config):
+    if options["backend"] == "local":
+        return LocalItemSource(config["local_items_path"])
+    return DynamoDBItemSource(config, options["chunk_rows"])
+
+
+def get_event_source(options, config):
+    if options["backend"] == "local":
+        return LocalEventSource(config["local_events_path"], options["chunk_rows"])
+    return S3EventSource(config, stream=options["stream_events"], chunk_rows=options["chunk_rows"])
+
+
+def get_report_sink(sheet_id, options, config):
+    if options["backend"] == "local":
+        return LocalReportSink(config["local_reports_dir"], options["report_format"])
+    return GoogleSheetsSink(sheet_id, diff=options["diff_sheets"])
@@ -0,0 +1,444 @@
+"""
+Offline benchmark for the pipeline stages.
+
+Generates synthetic DynamoDB items and Hive-partitioned SendGrid event Parquet,
+then runs each stage against local stand-ins and reports wall time, peak memory
+and API calls per stage:
+
+- DynamoDB: an in-memory table that serves Scan pages of generated items (about
+  1 MB each, numbers as Decimal) the way boto3's Table does. Items are generated
+  page by page, so 10M rows never sit in memory as dicts. FilterExpression is not
+  evaluated; every generated item falls on one of the benchmark days.
+- S3: moto's mock S3 for 1.download_parquet (skipped if moto is not installed),
+  and the local event directory for the streaming reader.
+- Sheets: a fake spreadsheet that counts values.batchUpdate calls and cells.
+
+Usage:
+    python benchmark.py --items 10000
+    python benchmark.py --items 1000000 --days 3 --events-per-item 4 --json bench.json
+
+Needs no AWS or Google credentials. Install moto to include the S3 download stage.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import google_sheet_utils
+import metrics
+import pipeline
+import sheets_writer
+from time_utils import JST
+
+BENCH_TABLE = "bench-items"
+BENCH_BUCKET = "bench-events/production"
+BENCH_REGION = "ap-northeast-1"
+BENCH_SHEET_ID = "bench-sheet"
+CREDS_FILE = "service_account.json"
+
+# DynamoDB returns at most 1 MB per Scan page
+APPROX_ITEM_BYTES = 400
+PAGE_ITEMS = 1_000_000 // APPROX_ITEM_BYTES
+MAX_EVENT_FILE_ROWS = 500_000
+
+REQUEST_STATUSES = np.array(["sent", "processing", "cancelled", "expired"])
+SMS_STATUSES = np.array(["delivered", "failed", "undelivered"])
+ANSWERS = np.array(["yes", "no", "no_answer"])
+CANCEL_REASONS = np.array(["price", "timing", "other"])
+TEMPLATES = np.array(["pricing_request_v1", "pricing_request_v2", "reminder"])
+EVENT_WEIGHTS = {
+    "processed": 0.30, "dropped": 0.01, "deferred": 0.03, "bounce": 0.01,
+    "delivered": 0.28, "open": 0.25, "click": 0.11, "spamreport": 0.01,
+}
+
+
+def day_starts(dates):
+    return np.array([
+        int(datetime(int(y), int(m), int(d), tzinfo=JST).timestamp()) for y, m, d in dates
+    ], dtype=np.int64)
+
+
+def request_ids(indices):
+    return np.char.mod("req-%09d", indices)
+
+
+def generate_items(start, stop, dates, seed=0):
+    """Items start..stop-1 as a DataFrame; item i falls on dates[i % len(dates)]."""
+    rng = np.random.default_rng(seed + start)
+    n = stop - start
+    indices = np.arange(start, stop)
+    day_start = day_starts(dates)[indices % len(dates)]
+
+    created = day_start + rng.integers(0, 86_000, n)
+    flow = np.minimum(created + rng.integers(0, 600, n), day_start + 86_399)
+    processing = flow + rng.integers(1, 300, n)
+    sent = processing + rng.integers(1, 300, n)
+    answered = rng.random(n) < 0.4
+    submitted = np.where(answered, sent + rng.integers(60, 86_400, n), -1)
+    status = REQUEST_STATUSES[rng.integers(0, len(REQUEST_STATUSES), n)]
+    cancelled = status == "cancelled"
+
+    return pd.DataFrame({
+        "request_id": request_ids(indices),
+        "created_at": created,
+        "expired_at": created + 7 * 86_400,
+        "flow_assessment": flow,
+        "processing_at": processing,
+        "sent_at": sent,
+        "updated_at": np.maximum(sent, submitted),
+        "submitted_at": submitted,
+        "request_status": status,
+        "sms_status": SMS_STATUSES[rng.integers(0, len(SMS_STATUSES), n)],
+        "answer": ANSWERS[rng.integers(0, len(ANSWERS), n)],
+        "total_price": rng.integers(100, 100_000, n),
+        "reason_cancel": np.where(cancelled, CANCEL_REASONS[rng.integers(0, len(CANCEL_REASONS), n)], ""),
+    })
+
+
+def to_dynamodb_items(df):
+    """Rows as boto3 resource items: numbers as Decimal, absent attributes left out."""
+    items = []
+    for row in df.to_dict("records"):
+        item = {}
+        for key, value in row.items():
+            if isinstance(value, str):
+                if value:
+                    item[key] = value
+            elif value >= 0:
+                item[key] = Decimal(int(value))
+        items.append(item)
+    return items
+
+
+class SyntheticTable:
+    """Stand-in for a boto3 DynamoDB Table serving Scan pages of generated items."""
+
+    def __init__(self, n_items, dates, seed=0):
+        self.n_items = n_items
+        self.dates = dates
+        self.seed = seed
+
+    def scan(self, **kwargs):
+        segment = kwargs.get("Segment", 0)
+        total_segments = kwargs.get("TotalSegments", 1)
+        low = self.n_items * segment // total_segments
+        high = self.n_items * (segment + 1) // total_segments
+        start = kwargs.get("ExclusiveStartKey", {}).get("i", low)
+        stop = min(high, start + PAGE_ITEMS)
+        items = to_dynamodb_items(generate_items(start, stop, self.dates, self.seed))
+        response = {
+            "Items": items,
+            "Count": len(items),
+            "ScannedCount": len(items),
+            # Eventually consistent reads: 0.5 RCU per 4 KB
+            "ConsumedCapacity": {"TableName": BENCH_TABLE, "CapacityUnits": len(items) * APPROX_ITEM_BYTES / 8192},
+        }
+        if stop < high:
+            response["LastEvaluatedKey"] = {"i": stop}
+        return response
+
+
+def write_events(root, dates, n_items, events_per_item, seed=0):
+    """
+    Write each day's events as year=/month=/day=/part-*.parquet under root.
+
+    Returns:
+        (rows, bytes) written.
+    """
+    rng = np.random.default_rng(seed + 1)
+    names = np.array(list(EVENT_WEIGHTS))
+    weights = np.array(list(EVENT_WEIGHTS.values()))
+    starts = day_starts(dates)
+    rows = size = 0
+    for offset, (year, month, day) in enumerate(dates):
+        indices = np.arange(offset, n_items, len(dates))
+        n = len(indices) * events_per_item
+        if n == 0:
+            continue
+        ids = request_ids(np.repeat(indices, events_per_item))
+        day_dir = os.path.join(root, f"year={year}", f"month={month}", f"day={day}")
+        os.makedirs(day_dir, exist_ok=True)
+        for part, lo in enumerate(range(0, n, MAX_EVENT_FILE_ROWS)):
+            hi = min(n, lo + MAX_EVENT_FILE_ROWS)
+            count = hi - lo
+            table = pa.table({
+                "request_id": ids[lo:hi],
+                "event": names[rng.choice(len(names), count, p=weights)],
+                "timestamp": starts[offset] + rng.integers(0, 86_400, count),
+                "sg_template_name": TEMPLATES[rng.integers(0, len(TEMPLATES), count)],
+                "email": np.char.add(ids[lo:hi], "@example.com"),
+                "sg_event_id": np.char.mod("evt-%012d", np.arange(lo, hi) + rows),
+                "sg_message_id": np.char.add("msg-", ids[lo:hi]),
+                "useragent": np.full(count, "Mozilla/5.0 (benchmark)"),
+            })
+            path = os.path.join(day_dir, f"part-{part:05d}.parquet")
+            pq.write_table(table, path, compression="snappy")
+            size += os.path.getsize(path)
+        rows += n
+    return rows, size
+
+
+class FakeSpreadsheet:
+    """Counts Sheets API calls and cells instead of sending them."""
+
+    def __init__(self):
+        self.calls = 0
+        self.cells = 0
+        self.ranges = 0
+
+    def values_batch_update(self, body):
+        self.calls += 1
+        self.ranges += len(body["data"])
+        self.cells += sum(len(row) for value_range in body["data"] for row in value_range["values"])
+
+    def values_batch_get(self, ranges, params=None):
+        self.calls += 1
+        return {"valueRanges": [{"range": r} for r in ranges]}
+
+
+class FakeClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        return self.spreadsheet
+
+
+class MemorySampler:
+    """Samples resident memory in the background to get the peak of each stage."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # No /proc (e.g. macOS): fall back to the lifetime peak
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def reset(self):
+        self.peak = self.rss()
+        return self.peak
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+API_COUNTERS = [
+    "dynamodb.pages", "dynamodb.consumed_capacity", "s3.list_pages", "s3.objects_downloaded",
+    "s3.bytes_downloaded", "s3.objects_streamed",
+]
+
+
+class Benchmark:
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.sampler = MemorySampler()
+        self.results = []
+
+    def run(self, name, func, rows_in=None):
+        """Run func() as one stage; func returns its output row count and result."""
+        counters_before = dict(metrics.summarize()["counters"])
+        sheets_before = (self.sheets.calls, self.sheets.cells)
+        start_rss = self.sampler.reset()
+        start = time.perf_counter()
+        rows_out, result = func()
+        seconds = time.perf_counter() - start
+        peak = max(self.sampler.peak, self.sampler.rss())
+        counters = metrics.summarize()["counters"]
+        api = {
+            name: round(counters.get(name, 0) - counters_before.get(name, 0), 2)
+            for name in API_COUNTERS if counters.get(name, 0) != counters_before.get(name, 0)
+        }
+        if self.sheets.calls != sheets_before[0]:
+            api["sheets.calls"] = self.sheets.calls - sheets_before[0]
+            api["sheets.cells"] = self.sheets.cells - sheets_before[1]
+        self.results.append({
+            "stage": name,
+            "seconds": round(seconds, 3),
+            "peak_rss_mb": round(peak / 2**20, 1),
+            "peak_delta_mb": round((peak - start_rss) / 2**20, 1),
+            "rows_in": rows_in,
+            "rows_out": rows_out,
+            "api_calls": api,
+        })
+        print(f"  {name}: {seconds:.2f}s, {rows_out} rows")
+        return result
+
+    def report(self):
+        header = f"{'Stage':<24} {'Seconds':>9} {'Peak MB':>9} {'+MB':>8} {'Rows in':>10} {'Rows out':>10}  API calls"
+        lines = [header, "-" * len(header)]
+        for r in self.results:
+            api = ", ".join(f"{k}={v}" for k, v in r["api_calls"].items())
+            lines.append(
+                f"{r['stage']:<24} {r['seconds']:>9.3f} {r['peak_rss_mb']:>9.1f} {r['peak_delta_mb']:>8.1f} "
+                f"{r['rows_in'] if r['rows_in'] is not None else '':>10} {r['rows_out']:>10}  {api}"
+            )
+        return "\n".join(lines)
+
+
+def upload_events_to_s3(client, events_root):
+    bucket, prefix = BENCH_BUCKET.split("/", 1)
+    client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": BENCH_REGION})
+    for root, _, files in os.walk(events_root):
+        for name in files:
+            path = os.path.join(root, name)
+            key = f"{prefix}/email-events/{os.path.relpath(path, events_root)}"
+            client.upload_file(path, bucket, key)
+
+
+def run_benchmark(args):
+    start_day = datetime.strptime(args.start_date, "%Y-%m-%d")
+    dates = [
+        ((start_day + timedelta(days=i)).strftime("%Y"), (start_day + timedelta(days=i)).strftime("%m"),
+         (start_day + timedelta(days=i)).strftime("%d"))
+        for i in range(args.days)
+    ]
+    download_item = pipeline.load_stage("download_item")
+    download_parquet = pipeline.load_stage("download_parquet")
+    beautify = pipeline.load_stage("beautify")
+    pivot = pipeline.load_stage("pivot")
+
+    # Local stand-ins
+    table = SyntheticTable(args.items, dates, args.seed)
+    download_item.get_table = lambda table_name, region_name: table
+    spreadsheet = FakeSpreadsheet()
+    google_sheet_utils.clear_cache()
+    google_sheet_utils._clients[os.path.abspath(CREDS_FILE)] = FakeClient(spreadsheet)
+    # No quota to respect; count calls instead of waiting
+    google_sheet_utils.write_bucket = google_sheet_utils.read_bucket = sheets_writer.TokenBucket(10**9)
+    metrics.reset()
+
+    print(f"Generating events for {args.items} items over {args.days} day(s)...")
+    events_root = os.path.abspath("events-source/email-events")
+    event_rows, event_bytes = write_events(events_root, dates, args.items, args.events_per_item, args.seed)
+    print(f"  {event_rows} events, {event_bytes / 2**20:.1f} MB of Parquet")
+
+    bench = Benchmark(spreadsheet)
+    print("Running stages...")
+    items_by_date = bench.run("0.download_item", lambda: (
+        lambda result: (sum(len(df) for df in result.values()), result)
+    )(download_item.download_items_for_range(BENCH_TABLE, BENCH_REGION, dates, args.segments,
+                                             batch_rows=args.chunk_rows)))
+
+    def stream_events():
+        events = {date: pivot.load_events_from_dataset(events_root, *date, batch_rows=args.chunk_rows) for date in dates}
+        metrics.count("s3.objects_streamed", sum(1 for _, _, files in os.walk(events_root) for _ in files))
+        return sum(len(df) for df in events.values()), events
+    events_by_date = bench.run("1.stream_events", stream_events)
+
+    if args.skip_s3_download:
+        print("  1.download_parquet: skipped (--skip-s3-download)")
+    else:
+        try:
+            from moto import mock_aws
+        except ImportError:
+            mock_aws = None
+            print("  1.download_parquet: skipped (pip install 'moto[s3]' to include it)")
+        if mock_aws is not None:
+            with mock_aws():
+                import boto3
+                upload_events_to_s3(boto3.client("s3", region_name=BENCH_REGION), events_root)
+
+                def download_events():
+                    events = {}
+                    for date in dates:
+                        event_dir = download_parquet.download_events_for_date(
+                            BENCH_BUCKET, None, *date, max_workers=args.workers
+                        )
+                        events[date] = pivot.load_merged_events(event_dir, args.chunk_rows)
+                    return sum(len(df) for df in events.values()), events
+                bench.run("1.download_parquet", download_events)
+
+    n_items = sum(len(df) for df in items_by_date.values())
+    beautified = bench.run("2.beautify", lambda: (
+        lambda result: (sum(len(df) for df in result.values()), result)
+    )({date: beautify.beautify_items(items_by_date[date], *date) for date in dates}), rows_in=n_items)
+
+    tables = bench.run("3.pivot", lambda: (
+        lambda result: (sum(len(df) for df in result.values()), result)
+    )({date: pivot.build_requests(beautified[date], events_by_date[date], *date) for date in dates}),
+        rows_in=sum(len(df) for df in beautified.values()) + event_rows)
+
+    n_requests = sum(len(df) for df in tables.values())
+
+    def upload_per_day():
+        for date, requests in tables.items():
+            pivot.upload_requests(requests, BENCH_SHEET_ID, date[2], CREDS_FILE)
+        return n_requests, None
+    bench.run("3.upload (per day)", upload_per_day, rows_in=n_requests)
+
+    def upload_batched():
+        pivot.upload_request_tabs({date[2]: requests for date, requests in tables.items()}, BENCH_SHEET_ID, CREDS_FILE)
+        return n_requests, None
+    bench.run("3.upload (batched)", upload_batched, rows_in=n_requests)
+
+    bench.sampler.close()
+    return bench, {"items": args.items, "days": args.days, "events": event_rows, "event_bytes": event_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the pipeline stages")
+    parser.add_argument("--items", type=int, default=10_000, help="Synthetic DynamoDB items (10k to 10M)")
+    parser.add_argument("--days", type=int, default=1, help="Days the items are spread over")
+    parser.add_argument("--events-per-item", type=int, default=4, help="SendGrid events per item")
+    parser.add_argument("--start-date", default="2026-01-01", help="First day (YYYY-MM-DD)")
+    parser.add_argument("--segments", type=int, default=4, help="Parallel scan segments")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent S3 downloads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-rows", type=int, default=0,
+                        help="Stream items and events in batches of this many rows (default off)")
+    parser.add_argument("--skip-s3-download", action="store_true", help="Skip the moto S3 download stage")
+    parser.add_argument("--workdir", help="Directory for generated and intermediate files (default: temporary)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    os.environ.update(AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", AWS_DEFAULT_REGION=BENCH_REGION)
+    os.environ.pop("AWS_PROFILE", None)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="automail-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        bench, scale = run_benchmark(args)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(bench.report())
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({"scale": scale, "stages": bench.results}, f, indent=2)
+        print(f"\nResults written to {json_path}")
+
+
+if __name__ == "__main__":
+    main()
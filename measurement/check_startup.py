@@ -0,0 +1,85 @@
+"""
+Start-up check for the CLI.
+
+Runs `run_all_scripts.py --dry-run` in a fresh interpreter and fails if it
+imported any heavy dependency (pandas, numpy, pyarrow, boto3, gspread, ...)
+or took longer than the time budget. Dry runs and date planning must stay
+cheap; the stages import what they need when they run.
+
+    python check_startup.py
+    python check_startup.py --budget 0.5 -- --year 2026 --month 01
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+HEAVY_MODULES = ["pandas", "numpy", "pyarrow", "boto3", "botocore", "gspread", "google.auth", "requests"]
+DEFAULT_BUDGET_SECONDS = 0.5
+DEFAULT_ARGS = ["--yesterday"]
+
+# Runs in the child interpreter; prints one JSON line after the CLI's own output
+PROBE = """
+import json, runpy, sys, time
+cli_args, heavy_modules = json.loads(sys.argv[1]), json.loads(sys.argv[2])
+sys.argv = ["run_all_scripts.py"] + cli_args
+start = time.perf_counter()
+try:
+    runpy.run_path("run_all_scripts.py", run_name="__main__")
+    code = 0
+except SystemExit as e:
+    code = e.code or 0
+print(json.dumps({
+    "exit_code": code,
+    "seconds": time.perf_counter() - start,
+    "heavy": sorted(name for name in heavy_modules if name in sys.modules),
+}))
+"""
+
+
+def check_startup(cli_args, budget_seconds=DEFAULT_BUDGET_SECONDS):
+    """
+    Dry-run the CLI with cli_args and return a list of problems (empty if it passed).
+
+    The time measured is from the start of run_all_scripts.py to its exit,
+    without the interpreter's own start-up.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, json.dumps(cli_args + ["--dry-run"]), json.dumps(HEAVY_MODULES)],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    )
+    lines = result.stdout.strip().splitlines()
+    try:
+        probe = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return [f"dry run crashed:\n{result.stdout}{result.stderr}"]
+
+    problems = []
+    if probe["exit_code"] != 0:
+        problems.append(f"dry run exited with status {probe['exit_code']}:\n{result.stdout}{result.stderr}")
+    if probe["heavy"]:
+        problems.append(f"dry run imported {', '.join(probe['heavy'])}")
+    if probe["seconds"] > budget_seconds:
+        problems.append(f"dry run took {probe['seconds']:.3f}s (budget {budget_seconds:.3f}s)")
+    print(f"Dry run of run_all_scripts.py {' '.join(cli_args)}: {probe['seconds'] * 1000:.0f} ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that CLI dry runs start fast without heavy imports")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET_SECONDS,
+                        help=f"Maximum seconds for the dry run (default {DEFAULT_BUDGET_SECONDS})")
+    parser.add_argument("cli_args", nargs="*", help="Arguments for run_all_scripts.py (default --yesterday)")
+    args = parser.parse_args()
+
+    problems = check_startup(args.cli_args or DEFAULT_ARGS, args.budget)
+    for problem in problems:
+        print(f"[ERROR] {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,319 @@
+import json
 import logging
+import os
+import threading
 import gspread
+from gspread.utils import absolute_range_name, rowcol_to_a1
 from google.oauth2.service_account import Credentials
 
-def update_google_sheet(sheet_id, sheet_name, range_names, values, creds_file):
+from sheets_writer import call_with_retry, read_bucket, write_bucket
+
+# Keep each write request well under the Sheets API request size limit
+MAX_PAYLOAD_BYTES = 1_000_000
+# Local copies of the last rows written to each tab, used by diff uploads
+SNAPSHOT_DIR = "data/sheet_snapshots"
+
+SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+# One authorized client per credentials file, plus opened spreadsheet/worksheet
+# handles, shared by everything in the process. gspread's authorized session
+# refreshes the token when it expires and keeps its HTTP connections alive.
+_clients = {}
+_spreadsheets = {}
+_worksheets = {}
+_lock = threading.Lock()
+
+
+def get_client(creds_file):
+    """Return the process-wide gspread client for a service account file (authorized once)."""
+    key = os.path.abspath(str(creds_file))
+    with _lock:
+        if key not in _clients:
+            creds = Credentials.from_service_account_file(key, scopes=SCOPES)
+            _clients[key] = gspread.authorize(creds)
+        return _clients[key]
+
+
+def open_spreadsheet(sheet_id, creds_file):
+    """Return a cached spreadsheet handle (one open_by_key per sheet per process)."""
+    key = (os.path.abspath(str(creds_file)), sheet_id)
+    with _lock:
+        if key in _spreadsheets:
+            return _spreadsheets[key]
+    # Opened outside the lock, so waiting on the quota does not block other sheets
+    spreadsheet = call_with_retry(get_client(creds_file).open_by_key, sheet_id, bucket=read_bucket)
+    with _lock:
+        return _spreadsheets.setdefault(key, spreadsheet)
+
+
+def get_worksheet(sheet_id, sheet_name, creds_file):
+    """Return a cached worksheet handle."""
+    key = (os.path.abspath(str(creds_file)), sheet_id, sheet_name)
+    with _lock:
+        if key in _worksheets:
+            return _worksheets[key]
+    spreadsheet = open_spreadsheet(sheet_id, creds_file)
+    worksheet = call_with_retry(spreadsheet.worksheet, sheet_name, bucket=read_bucket)
+    with _lock:
+        return _worksheets.setdefault(key, worksheet)
+
+
+def clear_cache():
+    """Forget every cached client and handle (e.g. after sheets were deleted or renamed)."""
+    with _lock:
+        _clients.clear()
+        _spreadsheets.clear()
+        _worksheets.clear()
+
+
+def chunk_rows(rows, max_payload_bytes=MAX_PAYLOAD_BYTES):
+    """
+    Split rows into consecutive chunks whose JSON payload stays under max_payload_bytes.
+
+    Yields:
+        (offset, chunk): Index of the chunk's first row and the rows themselves.
+    """
+    start = 0
+    size = 0
+    for index, row in enumerate(rows):
+        row_size = len(json.dumps(row, default=str)) + 1
+        if index > start and size + row_size > max_payload_bytes:
+            yield start, rows[start:index]
+            start, size = index, 0
+        size += row_size
+    if start < len(rows):
+        yield start, rows[start:]
+
+
+def block_value_ranges(sheet_name, rows, start_row=2, start_col=1, max_payload_bytes=MAX_PAYLOAD_BYTES):
+    """
+    Value ranges that write rows as one contiguous block, split into row chunks by payload size.
+
+    Returns:
+        list of (value_range, payload_bytes) tuples for values.batchUpdate.
+    """
+    value_ranges = []
+    if not rows:
+        return value_ranges
+    width = max(len(row) for row in rows)
+    for offset, chunk in chunk_rows(rows, max_payload_bytes):
+        first_row = start_row + offset
+        cells = (
+            f"{rowcol_to_a1(first_row, start_col)}:"
+            f"{rowcol_to_a1(first_row + len(chunk) - 1, start_col + width - 1)}"
+        )
+        size = sum(len(json.dumps(row, default=str)) + 1 for row in chunk)
+        value_ranges.append(({"range": absolute_range_name(sheet_name, cells), "values": chunk}, size))
+    return value_ranges
+
+
+def normalize_cell(value):
+    """
+    Comparable form of a cell: float for numbers, str otherwise.
+
+    None is kept apart from "": values.batchUpdate skips null cells, so a row
+    recorded with None may still hold an old value on the sheet.
+    """
+    if value is None:
+        return None
+    if value == "":
+        return ""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return str(value)
+
+
+def diff_value_ranges(sheet_name, old_rows, new_rows, start_row=2, start_col=1,
+                      max_payload_bytes=MAX_PAYLOAD_BYTES):
+    """
+    Value ranges that turn old_rows into new_rows on the sheet.
+
+    Only runs of consecutive changed rows are written; rows beyond the new
+    length (the day shrank) are blanked out. Empty cells are written as ""
+    so that values.batchUpdate clears them.
+
+    Returns:
+        list of (value_range, payload_bytes) tuples for values.batchUpdate.
+    """
+    width = max([len(row) for row in old_rows] + [len(row) for row in new_rows] + [1])
+
+    def normalized(rows, index):
+        row = rows[index] if index < len(rows) else []
+        return [normalize_cell(v) for v in row] + [""] * (width - len(row))
+
+    value_ranges = []
+    run_start = None
+    for index in range(max(len(old_rows), len(new_rows)) + 1):
+        changed = (
+            index < max(len(old_rows), len(new_rows))
+            and normalized(old_rows, index) != normalized(new_rows, index)
+        )
+        if changed and run_start is None:
+            run_start = index
+        elif not changed and run_start is not None:
+            run = [
+                ["" if v is None else v for v in new_rows[i]] + [""] * (width - len(new_rows[i]))
+                if i < len(new_rows) else [""] * width
+                for i in range(run_start, index)
+            ]
+            value_ranges.extend(
+                block_value_ranges(sheet_name, run, start_row + run_start, start_col, max_payload_bytes)
+            )
+            run_start = None
+    return value_ranges
+
+
+def send_value_ranges(spreadsheet, value_ranges, max_payload_bytes=MAX_PAYLOAD_BYTES):
+    """Send value ranges in as few values.batchUpdate calls as max_payload_bytes allows."""
+    batches = []
+    batch, batch_size = [], 0
+    for value_range, size in value_ranges:
+        if batch and batch_size + size > max_payload_bytes:
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(value_range)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    for batch in batches:
+        call_with_retry(
+            spreadsheet.values_batch_update, {"valueInputOption": "RAW", "data": batch}, bucket=write_bucket
+        )
+    return len(batches)
+
+
+def snapshot_path(snapshot_dir, sheet_id, sheet_name):
+    return os.path.join(snapshot_dir, sheet_id, f"{sheet_name}.json")
+
+
+def load_snapshot(snapshot_dir, sheet_id, sheet_name):
+    """Rows of the last upload to a tab, or None if there is no snapshot."""
+    path = snapshot_path(snapshot_dir, sheet_id, sheet_name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_snapshot(snapshot_dir, sheet_id, sheet_name, rows):
+    path = snapshot_path(snapshot_dir, sheet_id, sheet_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(rows, f, default=str)
+    os.replace(tmp_path, path)
+
+
+def fetch_tab_rows(spreadsheet, sheet_names, start_row=2, start_col=1, width=None):
+    """Current (unformatted) values of several tabs from start_row down, in one values.batchGet."""
+    if not sheet_names:
+        return {}
+    first_cell = rowcol_to_a1(start_row, start_col)
+    last_column = rowcol_to_a1(1, start_col + (width or 26) - 1).rstrip("0123456789")
+    ranges = [absolute_range_name(name, f"{first_cell}:{last_column}") for name in sheet_names]
+    response = call_with_retry(
+        spreadsheet.values_batch_get, ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"}, bucket=read_bucket
+    )
+    return {
+        name: value_range.get("values", [])
+        for name, value_range in zip(sheet_names, response.get("valueRanges", []))
+    }
+
+
+def update_google_sheet_rows(sheet_id, sheet_name, rows, creds_file, start_row=2, start_col=1,
+                             max_payload_bytes=MAX_PAYLOAD_BYTES, diff=False, snapshot_dir=None):
     """
-    Updates a Google Sheet with the specified values.
+    Write a block of rows to a worksheet as one contiguous range (e.g. "A2:Q120").
+
+    Large blocks are split into row chunks so each request stays under
+    max_payload_bytes; a normal day is a single API call. See
+    update_google_sheet_tabs for diff and snapshot_dir.
 
     Args:
         sheet_id (str): The ID of the Google Sheet.
-        range_name (str): The range to update (e.g., "Sheet1!A1:C3").
-        values (list of list): The values to insert (e.g., [["A", "B", "C"], [1, 2, 3]]).
+        sheet_name (str): The worksheet (tab) name.
+        rows (list of list): Row-major values, all rows the same width.
         creds_file (str): Path to the service account JSON credentials file.
+        start_row (int): Sheet row of the first value (1-based).
+        start_col (int): Sheet column of the first value (1-based).
 
     Returns:
-        str: Confirmation message.
+        int: Number of write requests sent.
+
+    Raises:
+        Exception: The API error, once retries are exhausted or it is not retryable.
     """
     try:
-        # Authenticate using the service account
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds = Credentials.from_service_account_file(creds_file, scopes=scope)
-        client = gspread.authorize(creds)
-
-        # Open the Google Sheet by ID
-        sheet = client.open_by_key(sheet_id)
-        worksheet = sheet.worksheet(sheet_name)
-        
-        # Update the specified ranges
-        for range_name, value in zip(range_names, values):
-            worksheet.update(range_name=range_name, values=value)
-
-        logging.info(f"Successfully updated range {range_name} in Google Sheet.")
+        requests_sent = update_google_sheet_tabs(
+            sheet_id, {sheet_name: rows}, creds_file, start_row, start_col, max_payload_bytes,
+            diff, snapshot_dir
+        )
+        logging.info(f"Successfully updated {len(rows)} rows in '{sheet_name}' with {requests_sent} request(s).")
+        return requests_sent
     except Exception as e:
         logging.error(f"Error updating Google Sheet: {str(e)}")
+        raise
+
+
+def update_google_sheet_tabs(sheet_id, tab_rows, creds_file, start_row=2, start_col=1,
+                             max_payload_bytes=MAX_PAYLOAD_BYTES, diff=False, snapshot_dir=None):
+    """
+    Write blocks of rows to several tabs of one spreadsheet with values.batchUpdate.
+
+    Ranges from all tabs are packed into as few calls as max_payload_bytes
+    allows; a tab too large for one call is split into row chunks. Errors are
+    raised (after retries) so the caller can tell that the batch did not go
+    through.
+
+    With diff=True each tab is compared with what it currently holds and only
+    changed rows are written; trailing rows left over from a longer previous
+    upload are blanked. The current contents come from the local snapshot of
+    the last upload when snapshot_dir has one, otherwise from a single
+    values.batchGet for all tabs. Snapshots are refreshed after every
+    successful write when snapshot_dir is set.
+
+    Args:
+        sheet_id (str): The ID of the Google Sheet.
+        tab_rows (dict): Worksheet name -> row-major values.
+        creds_file (str): Path to the service account JSON credentials file.
+        diff (bool): Write only the rows that changed.
+        snapshot_dir (str): Directory for local snapshots of uploaded tabs.
+
+    Returns:
+        int: Number of values.batchUpdate calls sent.
+    """
+    spreadsheet = open_spreadsheet(sheet_id, creds_file)
+
+    if diff:
+        current = {}
+        if snapshot_dir:
+            for sheet_name in tab_rows:
+                snapshot = load_snapshot(snapshot_dir, sheet_id, sheet_name)
+                if snapshot is not None:
+                    current[sheet_name] = snapshot
+        missing = [name for name in tab_rows if name not in current]
+        width = max([len(row) for rows in tab_rows.values() for row in rows] + [1])
+        current.update(fetch_tab_rows(spreadsheet, missing, start_row, start_col, width))
+        value_ranges = []
+        for sheet_name, rows in tab_rows.items():
+            value_ranges.extend(
+                diff_value_ranges(sheet_name, current[sheet_name], rows, start_row, start_col, max_payload_bytes)
+            )
+    else:
+        value_ranges = []
+        for sheet_name, rows in tab_rows.items():
+            value_ranges.extend(block_value_ranges(sheet_name, rows, start_row, start_col, max_payload_bytes))
+
+    calls = send_value_ranges(spreadsheet, value_ranges, max_payload_bytes)
+
+    if snapshot_dir:
+        for sheet_name, rows in tab_rows.items():
+            save_snapshot(snapshot_dir, sheet_id, sheet_name, rows)
+
+    logging.info(f"Successfully updated {len(tab_rows)} tabs with {calls} request(s).")
+    return calls
 
 
 def clone_template_sheet(template_id: str, new_name: str, creds_file: str) -> str:
@@ -47,15 +329,12 @@ def clone_template_sheet(template_id: str, new_name: str, creds_file: str) -> st
         The ID of the newly created Google Sheet.
     """
     try:
-        scope = [
-            "https://spreadsheets.google.com/feeds",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        creds = Credentials.from_service_account_file(creds_file, scopes=scope)
-        client = gspread.authorize(creds)
+        client = get_client(creds_file)
 
         # Copy the template
-        new_sheet = client.copy(template_id, title=new_name)
+        new_sheet = call_with_retry(
+            client.copy, template_id, title=new_name, bucket=write_bucket, idempotent=False
+        )
         new_sheet_id = new_sheet.id
         
         logging.info(f"Successfully cloned template to: {new_name} ({new_sheet_id})")
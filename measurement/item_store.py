@@ -0,0 +1,227 @@
+"""
+Local store of DynamoDB pricing-request items.
+Items are stored as Parquet partitioned by JST created date
+(data/items/date=YYYY-MM-DD/items.parquet) and upserted by request_id, so
+downloads are reused between runs and each day only reads its own partition.
+A watermark records the newest created_at/updated_at seen, so incremental runs
+only fetch items changed since the previous one.
+"""
+import json
+import os
+import shutil
+import threading
+from collections.abc import Mapping
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from schemas import COMPRESSION, ITEM_SCHEMA, conform, read_parquet, write_parquet
+from time_utils import JST_OFFSET_SECONDS
+
+DEFAULT_STORE_DIR = "data/items"
+ITEMS_FILE = "items.parquet"
+WATERMARK_FILE = "watermark.json"
+
+# Serializes read-merge-write of partitions when days run in parallel threads.
+# Only within one process: --jobs is rejected with --subprocess for this reason
+_upsert_lock = threading.Lock()
+UNKNOWN_DATE = "unknown"
+
+
+def partition_dates(df: pd.DataFrame) -> pd.Series:
+    """JST created date ('YYYY-MM-DD') of each item; UNKNOWN_DATE when created_at is missing."""
+    if "created_at" not in df.columns:
+        return pd.Series(UNKNOWN_DATE, index=df.index)
+    created_at = pd.to_numeric(df["created_at"], errors="coerce")
+    dates = pd.to_datetime(created_at + JST_OFFSET_SECONDS, unit="s").dt.strftime("%Y-%m-%d")
+    return dates.fillna(UNKNOWN_DATE)
+
+
+def partition_path(date_str: str, store_dir: str = DEFAULT_STORE_DIR) -> str:
+    return os.path.join(store_dir, f"date={date_str}", ITEMS_FILE)
+
+
+def list_partitions(store_dir: str = DEFAULT_STORE_DIR) -> list:
+    """Dates that have a partition in the store."""
+    if not os.path.exists(store_dir):
+        return []
+    return sorted(
+        name.split("=", 1)[1]
+        for name in os.listdir(store_dir)
+        if name.startswith("date=") and os.path.exists(os.path.join(store_dir, name, ITEMS_FILE))
+    )
+
+
+def load_partition(date_str: str, store_dir: str = DEFAULT_STORE_DIR) -> pd.DataFrame:
+    """Load one date partition (empty DataFrame if it does not exist)."""
+    return read_parquet(partition_path(date_str, store_dir), ITEM_SCHEMA)
+
+
+def load_items(dates=None, store_dir: str = DEFAULT_STORE_DIR) -> pd.DataFrame:
+    """
+    Load stored items.
+
+    Args:
+        dates: 'YYYY-MM-DD' strings of the partitions to read; None reads them all.
+        store_dir: Store directory.
+    """
+    if dates is None:
+        dates = list_partitions(store_dir)
+    frames = [df for df in (load_partition(d, store_dir) for d in dates) if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_partition(df: pd.DataFrame, date_str: str, store_dir: str = DEFAULT_STORE_DIR) -> None:
+    """Atomically replace one date partition."""
+    write_parquet(df, partition_path(date_str, store_dir), ITEM_SCHEMA)
+
+
+def drop_partition(date_str: str, store_dir: str = DEFAULT_STORE_DIR) -> None:
+    """Remove one date partition if it exists."""
+    shutil.rmtree(os.path.join(store_dir, f"date={date_str}"), ignore_errors=True)
+
+
+def upsert_items(df: pd.DataFrame, store_dir: str = DEFAULT_STORE_DIR,
+                 replace: bool = False, replace_dates=()) -> list:
+    """
+    Merge items into their date partitions by request_id; incoming rows win.
+
+    Only the partitions that receive items are rewritten. The partitions of
+    replace_dates are replaced instead of merged (and removed if df has no
+    items for them), so items deleted from the table drop out of those days.
+
+    Args:
+        df: Items fetched from DynamoDB.
+        store_dir: Store directory.
+        replace: Drop the whole store first (full refresh).
+        replace_dates: 'YYYY-MM-DD' dates that df fully covers.
+
+    Returns:
+        The dates of the partitions that were written.
+    """
+    replace_dates = set(replace_dates)
+    with _upsert_lock:
+        if replace and os.path.exists(store_dir):
+            for date_str in list_partitions(store_dir):
+                drop_partition(date_str, store_dir)
+        dates = partition_dates(df)
+        for date_str in replace_dates - set(dates):
+            drop_partition(date_str, store_dir)
+        if df.empty:
+            return []
+
+        written = []
+        for date_str, part in df.groupby(dates, sort=True):
+            existing = pd.DataFrame() if date_str in replace_dates else load_partition(date_str, store_dir)
+            merged = part if existing.empty else pd.concat([existing, part], ignore_index=True)
+            merged = merged.drop_duplicates(subset="request_id", keep="last").reset_index(drop=True)
+            write_partition(merged, date_str, store_dir)
+            written.append(date_str)
+        return written
+
+
+def upsert_batches(batches, store_dir: str = DEFAULT_STORE_DIR, replace: bool = False,
+                   replace_dates=()) -> tuple:
+    """
+    Upsert an iterable of item DataFrames with bounded memory.
+
+    Each batch is split by date and appended to a per-date spool file; the
+    spools are then merged into their partitions one date at a time, so only
+    one batch or one day of items is in memory at once.
+
+    Args:
+        batches: DataFrames of items fetched from DynamoDB.
+        store_dir: Store directory.
+        replace: Drop the whole store before merging (full refresh).
+        replace_dates: 'YYYY-MM-DD' dates the batches fully cover (see upsert_items).
+
+    Returns:
+        (number of items received, dates of the partitions written, newest change time)
+    """
+    spool_dir = os.path.join(store_dir, f"_spool.{os.getpid()}.{threading.get_ident()}")
+    writers = {}
+    count = 0
+    latest = None
+    try:
+        for df in batches:
+            if df.empty:
+                continue
+            count += len(df)
+            change = max_change_time(df)
+            if change is not None and (latest is None or change > latest):
+                latest = change
+            for date_str, part in df.groupby(partition_dates(df), sort=False):
+                if date_str not in writers:
+                    os.makedirs(spool_dir, exist_ok=True)
+                    writers[date_str] = pq.ParquetWriter(
+                        os.path.join(spool_dir, f"{date_str}.parquet"), ITEM_SCHEMA, compression=COMPRESSION
+                    )
+                writers[date_str].write_table(conform(part, ITEM_SCHEMA))
+        for writer in writers.values():
+            writer.close()
+
+        # Also empties the replace_dates partitions that received no items
+        upsert_items(pd.DataFrame(), store_dir, replace, set(replace_dates) - set(writers))
+        written = []
+        for date_str in sorted(writers):
+            written += upsert_items(read_parquet(os.path.join(spool_dir, f"{date_str}.parquet"), ITEM_SCHEMA),
+                                    store_dir, replace_dates=set(replace_dates) & {date_str})
+        return count, written, latest
+    finally:
+        for writer in writers.values():
+            writer.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+class PartitionView(Mapping):
+    """
+    Read-only {(year, month, day): items} over store partitions.
+
+    Each day is loaded from its partition on access, so a month of items is
+    never held in memory at once.
+    """
+
+    def __init__(self, dates, store_dir: str = DEFAULT_STORE_DIR):
+        self.dates = list(dates)
+        self.store_dir = store_dir
+
+    def __getitem__(self, date):
+        if date not in self.dates:
+            raise KeyError(date)
+        year, month, day = date
+        return load_partition(f"{year}-{month}-{day}", self.store_dir)
+
+    def __iter__(self):
+        return iter(self.dates)
+
+    def __len__(self):
+        return len(self.dates)
+
+
+def read_watermark(store_dir: str = DEFAULT_STORE_DIR):
+    """Return the stored watermark (epoch seconds), or None before the first sync."""
+    path = os.path.join(store_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get("watermark")
+
+
+def write_watermark(watermark: int, store_dir: str = DEFAULT_STORE_DIR) -> None:
+    """Persist the watermark (epoch seconds)."""
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, WATERMARK_FILE), "w") as f:
+        json.dump({"watermark": int(watermark)}, f)
+
+
+def max_change_time(df: pd.DataFrame):
+    """Newest created_at/updated_at in the items, or None if there is none."""
+    latest = None
+    for column in ("created_at", "updated_at"):
+        if column in df.columns:
+            value = pd.to_numeric(df[column], errors="coerce").max()
+            if pd.notna(value) and (latest is None or value > latest):
+                latest = int(value)
+    return latest
@@ -0,0 +1,149 @@
+"""
+Lightweight run metrics: stage timings, counters and external-call latencies.
+
+Stages are timed with `with metrics.stage("beautify", date) as m:` and can
+report rows via m["rows_in"] / m["rows_out"]. External calls add to counters
+(metrics.count("dynamodb.pages")) and latencies (metrics.observe(...)).
+Everything is process-wide and thread-safe; write_report() saves a JSON file
+and a Markdown summary (also appended to $GITHUB_STEP_SUMMARY when set).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_METRICS_DIR = "data/metrics"
+
+_lock = threading.Lock()
+_stages = []
+_counters = {}
+_latencies = {}
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _latencies.clear()
+
+
+@contextmanager
+def stage(name, date=None):
+    """Time a stage; the yielded dict takes optional rows_in/rows_out."""
+    record = {"stage": name, "date": date, "rows_in": None, "rows_out": None}
+    start = time.perf_counter()
+    try:
+        yield record
+        record.setdefault("ok", True)
+    except Exception:
+        record["ok"] = False
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        with _lock:
+            _stages.append(record)
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Record the latency of one external call."""
+    with _lock:
+        _latencies.setdefault(name, []).append(seconds)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize():
+    """Return the run's metrics as a JSON-serializable dict."""
+    with _lock:
+        stages = list(_stages)
+        counters = dict(_counters)
+        latencies = {name: list(values) for name, values in _latencies.items()}
+
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record["stage"], {
+            "runs": 0, "failed": 0, "seconds": 0.0, "max_seconds": 0.0, "rows_in": 0, "rows_out": 0,
+        })
+        total["runs"] += 1
+        total["failed"] += 0 if record.get("ok") else 1
+        total["seconds"] = round(total["seconds"] + record["seconds"], 4)
+        total["max_seconds"] = max(total["max_seconds"], record["seconds"])
+        total["rows_in"] += record["rows_in"] or 0
+        total["rows_out"] += record["rows_out"] or 0
+
+    return {
+        "stages": stages,
+        "stage_totals": totals,
+        "counters": counters,
+        "latencies": {
+            name: {
+                "calls": len(values),
+                "total_seconds": round(sum(values), 4),
+                "p50_seconds": round(percentile(values, 0.5), 4),
+                "p95_seconds": round(percentile(values, 0.95), 4),
+                "max_seconds": round(max(values), 4),
+            }
+            for name, values in latencies.items()
+        },
+    }
+
+
+def to_markdown(summary, title="Automail run metrics"):
+    lines = [f"### {title}", "", "| Stage | Runs | Failed | Total s | Max s | Rows in | Rows out |",
+             "|-------|-----:|-------:|--------:|------:|--------:|---------:|"]
+    for name, total in summary["stage_totals"].items():
+        lines.append(
+            f"| {name} | {total['runs']} | {total['failed']} | {total['seconds']:.2f} | "
+            f"{total['max_seconds']:.2f} | {total['rows_in']} | {total['rows_out']} |"
+        )
+    if summary["counters"]:
+        lines += ["", "| Counter | Value |", "|---------|------:|"]
+        for name, value in sorted(summary["counters"].items()):
+            value = f"{value:.1f}" if isinstance(value, float) else value
+            lines.append(f"| {name} | {value} |")
+    if summary["latencies"]:
+        lines += ["", "| Call | Count | Total s | p50 s | p95 s | Max s |",
+                  "|------|------:|--------:|------:|------:|------:|"]
+        for name, latency in sorted(summary["latencies"].items()):
+            lines.append(
+                f"| {name} | {latency['calls']} | {latency['total_seconds']:.2f} | {latency['p50_seconds']:.3f} | "
+                f"{latency['p95_seconds']:.3f} | {latency['max_seconds']:.3f} |"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def write_report(metrics_dir=DEFAULT_METRICS_DIR, extra=None):
+    """
+    Write metrics_<timestamp>.json and .md under metrics_dir.
+
+    extra is merged into the JSON (e.g. the run's arguments). The Markdown is
+    also appended to $GITHUB_STEP_SUMMARY when running in GitHub Actions.
+
+    Returns:
+        (json_path, markdown_path)
+    """
+    summary = {**(extra or {}), **summarize()}
+    os.makedirs(metrics_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    json_path = os.path.join(metrics_dir, f"metrics_{stamp}.json")
+    markdown_path = os.path.join(metrics_dir, f"metrics_{stamp}.md")
+    with open(json_path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    markdown = to_markdown(summary)
+    with open(markdown_path, "w") as f:
+        f.write(markdown)
+    step_summary = os.getenv("GITHUB_STEP_SUMMARY")
+    if step_summary:
+        with open(step_summary, "a") as f:
+            f.write(markdown)
+    return json_path, markdown_path
@@ -0,0 +1,300 @@
+"""
+In-process pipeline engine for Automail Analytics.
+Loads the numbered stage scripts as modules and runs them in one interpreter,
+passing DataFrames between stages in memory instead of through intermediate files.
+"""
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+import backends
+import metrics
+import stage_cache
+
+BASE_DIR = Path(__file__).parent
+
+STAGE_FILES = {
+    "download_item": "0.download_item.py",
+    "download_parquet": "1.download_parquet.py",
+    "beautify": "2.beautify.py",
+    "pivot": "3.pivot.py",
+}
+
+# Code whose changes invalidate stored build fingerprints
+SOURCE_FILES = list(STAGE_FILES.values()) + ["schemas.py", "time_utils.py"]
+
+_stages = {}
+_stages_lock = threading.Lock()
+
+
+def load_stage(name: str):
+    """Import a numbered stage script (e.g. "0.download_item.py") as a module, once per process."""
+    with _stages_lock:
+        if name not in _stages:
+            path = BASE_DIR / STAGE_FILES[name]
+            spec = importlib.util.spec_from_file_location(f"stage_{name}", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _stages[name] = module
+        return _stages[name]
+
+
+def map_dates(func, dates: list, jobs: int = 1) -> list:
+    """
+    Call func(year, month, day) for every date, on up to jobs threads.
+
+    Days write to their own paths (item store partition, email-events/ day
+    folder, per-day output files), so they can run side by side. Results are
+    returned in the order of dates.
+    """
+    if jobs <= 1 or len(dates) <= 1:
+        return [func(*date) for date in dates]
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="day") as pool:
+        return list(pool.map(lambda date: func(*date), dates))
+
+
+def get_config() -> dict:
+    """Read pipeline settings from .env / environment."""
+    load_dotenv()
+    return {
+        "table_name": os.getenv("TABLE_NAME"),
+        "region_name": os.getenv("REGION"),
+        "scan_segments": int(os.getenv("SCAN_SEGMENTS", "1")),
+        "index_name": os.getenv("ITEMS_INDEX_NAME") or None,
+        "index_key": os.getenv("ITEMS_INDEX_KEY", "created_date"),
+        "bucket_name": os.getenv("BUCKET_NAME"),
+        "profile_name": os.getenv("AWS_PROFILE"),
+        "s3_workers": int(os.getenv("S3_DOWNLOAD_WORKERS", "8")),
+        "events_uri": os.getenv("EVENTS_URI") or f"s3://{os.getenv('BUCKET_NAME')}/email-events",
+        "s3_endpoint_url": os.getenv("S3_ENDPOINT_URL") or None,
+        "local_items_path": os.getenv("LOCAL_ITEMS_PATH", "data/items"),
+        "local_events_path": os.getenv("LOCAL_EVENTS_PATH", "email-events"),
+        "local_reports_dir": os.getenv("LOCAL_REPORTS_DIR", "reports"),
+    }
+
+
+def get_events_source(config: dict):
+    """
+    Return (root, filesystem) of the event dataset for streaming reads.
+
+    S3_ENDPOINT_URL points the S3 filesystem at a stand-in such as a mock S3 server;
+    EVENTS_URI may also be a local directory.
+    """
+    uri = config["events_uri"]
+    if config["s3_endpoint_url"] and uri.startswith("s3://"):
+        import pyarrow.fs as pafs
+        scheme, _, endpoint = config["s3_endpoint_url"].partition("://")
+        filesystem = pafs.S3FileSystem(
+            endpoint_override=endpoint, scheme=scheme, region=config["region_name"] or "us-east-1"
+        )
+        return uri[len("s3://"):], filesystem
+    return uri, None
+
+
+# Run options shared by every day of a run (set from run_all_scripts.py flags)
+DEFAULT_OPTIONS = {
+    "incremental": False,     # sync the item store with changed items only
+    "full_refresh": False,    # with incremental: rebuild the item store
+    "stream_events": False,   # read events straight from S3, skip the download stage
+    "export_csv": False,      # also write requests/*.csv
+    "batch_sheets": False,    # upload every day's tab at the end in batched calls
+    "diff_sheets": False,     # write only the Sheets rows that changed since the last upload
+    "jobs": 1,                # days processed in parallel
+    "force": False,           # rebuild and re-upload days whose inputs are unchanged
+    "backend": "aws",         # "local": item snapshot + local events -> local report files
+    "report_format": "parquet",  # local backend report files: parquet or csv
+    "chunk_rows": 0,          # >0: stream items and events in record batches of this size
+}
+
+
+def get_options(options=None) -> dict:
+    return {**DEFAULT_OPTIONS, **(options or {})}
+
+
+def prefetch_items(dates: list, options=None) -> dict:
+    """
+    Read the item source once for all dates and return the raw items split per day.
+
+    With the AWS backend the downloaded items are also saved to the local item
+    store. In incremental mode the store is synced (only changed items are
+    fetched) and each day is read back from its own partition. With chunk_rows
+    the items are streamed into the store and each day is only loaded from its
+    partition when it is built.
+    """
+    options = get_options(options)
+    item_source = backends.get_item_source(options, get_config())
+    with metrics.stage("prefetch_items") as stage:
+        items_by_date = item_source.fetch_range(dates, options["incremental"], options["full_refresh"])
+        if isinstance(items_by_date, dict):
+            stage["rows_out"] = sum(len(items) for items in items_by_date.values())
+    return items_by_date
+
+
+def build_date(year: str, month: str, day: str, raw_items=None, options=None):
+    """
+    Run stages 0-3 for a single date, without the report upload.
+
+    If raw_items is given (from prefetch_items), the item download is skipped.
+    Items and events come from the backends selected in options: DynamoDB and
+    S3 (synced, or streamed with stream_events), or the local mirror. The
+    request table is saved as Parquet, and also as CSV when export_csv is set.
+
+    Unless options["force"] is set, loading events, beautify and pivot are
+    skipped when the day's items, event listing and stage code match the last
+    successful build; the saved request table is returned instead.
+
+    Returns:
+        DataFrame of the day's request rows.
+    """
+    options = get_options(options)
+    config = get_config()
+    item_source = backends.get_item_source(options, config)
+    event_source = backends.get_event_source(options, config)
+    beautify = load_stage("beautify")
+    pivot = load_stage("pivot")
+
+    date_str = f"{year}-{month}-{day}"
+    if raw_items is None:
+        with metrics.stage("fetch_items", date_str) as stage:
+            raw_items = item_source.fetch_date(year, month, day)
+            stage["rows_out"] = len(raw_items)
+
+    with metrics.stage("list_events", date_str) as stage:
+        event_listing = event_source.listing(year, month, day)
+        stage["rows_out"] = len(event_listing)
+    fingerprint = stage_cache.digest(
+        stage_cache.frame_digest(raw_items),
+        event_listing,
+        stage_cache.source_digest(BASE_DIR / name for name in SOURCE_FILES),
+        options["export_csv"],
+    )
+    if not options["force"] and stage_cache.is_fresh(date_str, "build", fingerprint) \
+            and os.path.exists(pivot.requests_path(year, month, day)):
+        print(f"[SKIP] Inputs for {date_str} unchanged since the last build")
+        metrics.count("days.build_skipped")
+        return pivot.load_requests(year, month, day)
+
+    with metrics.stage("load_events", date_str) as stage:
+        events = event_source.load(year, month, day, event_listing)
+        stage["rows_out"] = len(events)
+
+    with metrics.stage("beautify", date_str) as stage:
+        items = beautify.beautify_items(raw_items, year, month, day)
+        stage["rows_in"], stage["rows_out"] = len(raw_items), len(items)
+
+    with metrics.stage("pivot", date_str) as stage:
+        requests = pivot.build_requests(items, events, year, month, day)
+        for output_filepath in pivot.save_requests(requests, year, month, day, options["export_csv"]):
+            print(f"Writing requests to {output_filepath}")
+        stage["rows_in"], stage["rows_out"] = len(items) + len(events), len(requests)
+    stage_cache.record(date_str, "build", fingerprint)
+    return requests
+
+
+def upload_fingerprint(requests, target: str) -> str:
+    return stage_cache.digest(stage_cache.frame_digest(requests), target)
+
+
+def upload_date(requests, year: str, month: str, day: str, sheet_id: str, options=None) -> None:
+    """
+    Write one day's request table to the report sink (raises if the write fails).
+
+    Skipped, unless options["force"] is set, when the same table was already
+    written to this sheet (or local report directory).
+    """
+    options = get_options(options)
+    sink = backends.get_report_sink(sheet_id, options, get_config())
+    date_str = f"{year}-{month}-{day}"
+    fingerprint = upload_fingerprint(requests, sink.target)
+    if not options["force"] and stage_cache.is_fresh(date_str, "upload", fingerprint):
+        print(f"[SKIP] Report for {date_str} already up to date in {sink.target}")
+        metrics.count("days.upload_skipped")
+        return
+    with metrics.stage("upload", date_str) as stage:
+        destination = sink.write_day(requests, year, month, day)
+        stage["rows_in"] = len(requests)
+    stage_cache.record(date_str, "upload", fingerprint)
+    print(f"Updated report with data for {year}-{month}-{day}: {destination}")
+
+
+def run_date(year: str, month: str, day: str, sheet_id: str, raw_items=None, options=None,
+             writer=None) -> bool:
+    """
+    Run all four stages for a single date in the current process, including the upload.
+
+    With a SheetsWriter the upload is queued and this returns as soon as the
+    day is built; upload failures are then reported by writer.wait().
+    """
+    try:
+        requests = build_date(year, month, day, raw_items, options)
+        if writer is not None:
+            writer.submit((year, month, day), upload_date, requests, year, month, day, sheet_id, options)
+        else:
+            upload_date(requests, year, month, day, sheet_id, options)
+    except Exception as e:
+        print(f"[ERROR] Pipeline failed for {year}-{month}-{day}: {e}")
+        return False
+    return True
+
+
+def run_dates_batched(dates: list, sheet_id: str, items_by_date=None, options=None) -> dict:
+    """
+    Build every date's request table first, then upload all tabs together.
+
+    The tabs go out in as few values.batchUpdate calls as the payload limit
+    allows. A failure after the first call leaves the sheet partly written;
+    all uploaded days are then reported as failed and not recorded in the
+    stage cache, so the next run writes them again. Days whose table was
+    already uploaded to this sheet are left out unless options["force"] is set.
+
+    Returns:
+        Dict mapping each (year, month, day) to True/False.
+    """
+    options = get_options(options)
+    sink = backends.get_report_sink(sheet_id, options, get_config())
+    items_by_date = items_by_date or {}
+
+    def build_one(year, month, day):
+        print(f"\n=== Building {year}-{month}-{day} ===")
+        try:
+            return build_date(year, month, day, items_by_date.get((year, month, day)), options)
+        except Exception as e:
+            print(f"[ERROR] Pipeline failed for {year}-{month}-{day}: {e}")
+            return None
+
+    built = map_dates(build_one, dates, options["jobs"])
+    results = {date: requests is not None for date, requests in zip(dates, built)}
+
+    tables = {}
+    fingerprints = {}
+    for (year, month, day), requests in zip(dates, built):
+        if requests is None:
+            continue
+        date_str = f"{year}-{month}-{day}"
+        fingerprint = upload_fingerprint(requests, sink.target)
+        if not options["force"] and stage_cache.is_fresh(date_str, "upload", fingerprint):
+            print(f"[SKIP] Report for {date_str} already up to date in {sink.target}")
+            metrics.count("days.upload_skipped")
+            continue
+        tables[(year, month, day)] = requests
+        fingerprints[date_str] = fingerprint
+
+    if tables:
+        try:
+            with metrics.stage("upload_batched") as stage:
+                calls = sink.write_days(tables)
+                stage["rows_in"] = sum(len(requests) for requests in tables.values())
+            days = ", ".join(day for _, _, day in tables)
+            print(f"Updated report days {days} in {calls} request(s) - {sink.target}")
+        except Exception as e:
+            print(f"[ERROR] Batched report upload failed: {e}")
+            for date in tables:
+                results[date] = False
+            return results
+        for date_str, fingerprint in fingerprints.items():
+            stage_cache.record(date_str, "upload", fingerprint)
+    return results
@@ -2,6 +2,7 @@
 Main script to run all data processing scripts for Automail Analytics.
 Supports CLI arguments for automation via GitHub Actions.
 """
+import os
 import subprocess
 import sys
 import argparse
@@ -9,6 +10,8 @@ from calendar import monthrange
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import metrics
+
 
 def get_sheet_id(year: str, month: str, dry_run: bool = False) -> str:
     """Get or create sheet ID for the given month."""
@@ -17,7 +20,6 @@ def get_sheet_id(year: str, month: str, dry_run: bool = False) -> str:
         return get_or_create_monthly_sheet(year, month, dry_run)
     except ImportError:
         # Fallback: use SHEET_ID from env
-        import os
         from dotenv import load_dotenv
         load_dotenv()
         return os.getenv("SHEET_ID", "")
@@ -37,7 +39,8 @@ def run_script(script_name: str, year: str, month: str, day: str, sheet_id: str)
     return True
 
 
-def process_date(year: str, month: str, day: str, sheet_id: str, dry_run: bool = False) -> bool:
+def process_date(year: str, month: str, day: str, sheet_id: str, dry_run: bool = False,
+                 use_subprocess: bool = False, raw_items=None, options=None, writer=None) -> bool:
     """Process data for a single date."""
     scripts = [
         "0.download_item.py",
@@ -49,17 +52,78 @@ def process_date(year: str, month: str, day: str, sheet_id: str, dry_run: bool =
     print(f"\n=== Processing {year}-{month}-{day} ===")
     
     if dry_run:
-        print(f"[DRY-RUN] Would run scripts: {scripts}")
+        mode = "subprocess" if use_subprocess else "in-process"
+        print(f"[DRY-RUN] Would run scripts ({mode}): {scripts}")
         print(f"[DRY-RUN] Sheet ID: {sheet_id}")
         return True
     
+    if not use_subprocess:
+        from pipeline import run_date
+        return run_date(year, month, day, sheet_id, raw_items, options, writer)
+    
     for script in scripts:
-        if not run_script(script, year, month, day, sheet_id):
+        # Only wall time is visible from here; the scripts' own metrics stay in their processes
+        with metrics.stage(script, f"{year}-{month}-{day}") as stage:
+            ok = run_script(script, year, month, day, sheet_id)
+            stage["ok"] = ok
+        if not ok:
             print(f"Stopping execution due to error in {script}")
             return False
     return True
 
 
+def process_dates(dates: list, sheet_id: str, dry_run: bool = False,
+                  use_subprocess: bool = False, options=None) -> int:
+    """Process several dates and return the number that succeeded."""
+    options = options or {}
+    items_by_date = {}
+    if not dry_run and not use_subprocess and (len(dates) > 1 or options.get("incremental")):
+        # One DynamoDB read for the whole range instead of one per day
+        from pipeline import prefetch_items
+        try:
+            items_by_date = prefetch_items(dates, options)
+        except Exception as e:
+            print(f"[WARNING] Range download failed, falling back to per-day scans: {e}")
+
+    if not dry_run and not use_subprocess and options.get("batch_sheets"):
+        from pipeline import run_dates_batched
+        results = run_dates_batched(dates, sheet_id, items_by_date, options)
+        return sum(results.values())
+
+    jobs = options.get("jobs", 1)
+    if dry_run:
+        return sum(process_date(year, month, day, sheet_id, dry_run, use_subprocess) for year, month, day in dates)
+    if use_subprocess:
+        return sum(process_date(year, month, day, sheet_id, use_subprocess=True) for year, month, day in dates)
+    from pipeline import map_dates
+
+    # Uploads run in the background while the next day is built
+    from sheets_writer import SheetsWriter
+    with SheetsWriter() as writer:
+        results = map_dates(
+            lambda year, month, day: process_date(
+                year, month, day, sheet_id, raw_items=items_by_date.get((year, month, day)),
+                options=options, writer=writer
+            ),
+            dates, jobs
+        )
+        success_count = sum(results)
+        for (year, month, day), error in writer.wait().items():
+            print(f"[ERROR] Sheets upload failed for {year}-{month}-{day}: {error}")
+            success_count -= 1
+    return success_count
+
+
+def report_metrics(dates: list, success_count: int, options: dict) -> None:
+    """Write the run's metrics JSON and Markdown summary (see metrics.py)."""
+    json_path, markdown_path = metrics.write_report(extra={
+        "dates": [f"{year}-{month}-{day}" for year, month, day in dates],
+        "succeeded": success_count,
+        "options": options,
+    })
+    print(f"Metrics written to {json_path} and {markdown_path}")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Automail Analytics Data Processing",
@@ -71,6 +135,11 @@ Examples:
   python run_all_scripts.py --year 2026 --month 01   # Process entire month
   python run_all_scripts.py --month-to-date          # Process from 1st to today
   python run_all_scripts.py --yesterday --dry-run    # Preview without executing
+  python run_all_scripts.py --yesterday --subprocess # Run each stage as a separate script
+  python run_all_scripts.py --yesterday --incremental  # Only fetch items changed since last run
+  python run_all_scripts.py --yesterday --stream-events  # Read S3 events without a local copy
+  python run_all_scripts.py --yesterday --export-csv     # Also write requests/*.csv
+  python run_all_scripts.py --year 2026 --month 01 --batch-sheets  # One batched upload for the month
         """
     )
     
@@ -107,6 +176,73 @@ Examples:
         action="store_true",
         help="Print actions without executing"
     )
+    parser.add_argument(
+        "--subprocess",
+        action="store_true",
+        help="Run each stage script in its own interpreter (legacy mode)"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Sync only DynamoDB items changed since the last run into the local item store"
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="With --incremental, re-download the whole table and rebuild the item store"
+    )
+    parser.add_argument(
+        "--stream-events",
+        action="store_true",
+        help="Read SendGrid events directly from S3 instead of downloading them first"
+    )
+    parser.add_argument(
+        "--export-csv",
+        action="store_true",
+        help="Also export each day's request table as CSV under requests/"
+    )
+    parser.add_argument(
+        "--batch-sheets",
+        action="store_true",
+        help="Build every day first, then write all daily tabs in batched Sheets calls"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Process up to N days in parallel (default 1; not with --subprocess)"
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Stream items and events in batches of N rows to bound memory on large days and months (default off)"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["aws", "local"],
+        default="aws",
+        help="aws: DynamoDB/S3/Google Sheets (default); "
+             "local: item snapshot + local email-events/ -> report files under reports/"
+    )
+    parser.add_argument(
+        "--report-format",
+        choices=["parquet", "csv"],
+        default="parquet",
+        help="File format of the local backend's reports (default parquet)"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild and re-upload every day, even if its inputs are unchanged since the last run"
+    )
+    parser.add_argument(
+        "--diff-sheets",
+        action="store_true",
+        help="Write only the Sheets rows that changed since the last upload"
+    )
     
     args = parser.parse_args()
     
@@ -115,6 +251,42 @@ Examples:
         parser.error("--year requires --month")
     if args.month and not args.year:
         parser.error("--month requires --year")
+    if args.full_refresh and not args.incremental:
+        parser.error("--full-refresh requires --incremental")
+    if args.subprocess and (args.incremental or args.stream_events):
+        parser.error("--incremental and --stream-events cannot be used with --subprocess")
+    if args.subprocess and args.batch_sheets:
+        parser.error("--batch-sheets cannot be used with --subprocess")
+    if args.backend == "local" and (args.subprocess or args.incremental or args.stream_events or args.diff_sheets):
+        parser.error("--backend local cannot be used with --subprocess, --incremental, --stream-events or --diff-sheets")
+    if args.export_csv:
+        # Picked up by 3.pivot.py when it runs as a subprocess
+        os.environ["EXPORT_CSV"] = "1"
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.chunk_rows < 0:
+        parser.error("--chunk-rows must not be negative")
+    if args.subprocess and args.chunk_rows:
+        parser.error("--chunk-rows cannot be used with --subprocess")
+    if args.subprocess and args.jobs > 1:
+        # Each day's process rewrites the item store partitions around its day
+        parser.error("--jobs cannot be used with --subprocess")
+    if args.diff_sheets:
+        os.environ["DIFF_SHEETS"] = "1"
+    
+    options = {
+        "incremental": args.incremental,
+        "full_refresh": args.full_refresh,
+        "stream_events": args.stream_events,
+        "export_csv": args.export_csv,
+        "batch_sheets": args.batch_sheets,
+        "diff_sheets": args.diff_sheets,
+        "backend": args.backend,
+        "report_format": args.report_format,
+        "jobs": args.jobs,
+        "force": args.force,
+        "chunk_rows": args.chunk_rows,
+    }
     
     # Determine dates to process
     dates_to_process = []
@@ -164,10 +336,8 @@ Examples:
         print(f"Sheet ID: {sheet_id}")
         print(f"{'='*50}\n")
         
-        success_count = 0
-        for y, m, d in dates_to_process:
-            if process_date(y, m, d, sheet_id, False):
-                success_count += 1
+        success_count = process_dates(dates_to_process, sheet_id, False, args.subprocess, options)
+        report_metrics(dates_to_process, success_count, options)
         
         print(f"\n{'='*50}")
         print(f"Completed: {success_count}/{len(dates_to_process)} dates processed successfully")
@@ -179,19 +349,23 @@ Examples:
     
     # Get sheet ID for the month (auto-lookup)
     first_year, first_month, _ = dates_to_process[0]
-    sheet_id = get_sheet_id(first_year, first_month, args.dry_run)
+    if args.backend == "local":
+        # Reports go to local files; no monthly sheet is needed
+        sheet_id = ""
+    else:
+        sheet_id = get_sheet_id(first_year, first_month, args.dry_run)
     
     print(f"\n{'='*50}")
     print(f"Processing {len(dates_to_process)} date(s)")
     print(f"Sheet ID: {sheet_id}")
+    print(f"Backend: {args.backend}")
     print(f"Dry run: {args.dry_run}")
     print(f"{'='*50}\n")
     
     # Process each date
-    success_count = 0
-    for year, month, day in dates_to_process:
-        if process_date(year, month, day, sheet_id, args.dry_run):
-            success_count += 1
+    success_count = process_dates(dates_to_process, sheet_id, args.dry_run, args.subprocess, options)
+    if not args.dry_run:
+        report_metrics(dates_to_process, success_count, options)
     
     print(f"\n{'='*50}")
     print(f"Completed: {success_count}/{len(dates_to_process)} dates processed successfully")
@@ -0,0 +1,163 @@
+"""
+Explicit Parquet schemas for the pipeline's intermediate artifacts.
+Every intermediate file (item store partitions, beautified items, merged events,
+request tables) is written and read through these, so dtypes survive the
+round trip instead of being re-inferred from CSV.
+
+Data is kept compact in memory: low-cardinality strings are dictionary-encoded
+(pandas categoricals), epochs are nullable integers, prices are floats and JST
+times are tz-aware datetimes. Strings are only rendered for the Sheets/CSV
+output (see 3.pivot.render_requests).
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from time_utils import to_jst
+
+COMPRESSION = "zstd"
+
+# Low-cardinality strings (statuses, answers, event names, template names)
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+# JST datetimes (the *_jp item columns and the request table's times)
+JST_TIMESTAMP = pa.timestamp("s", tz="+09:00")
+
+TIMESTAMP_COLUMNS = [
+    "created_at",
+    "expired_at",
+    "flow_assessment",
+    "processing_at",
+    "sent_at",
+    "updated_at",
+    "submitted_at",
+]
+
+# Raw DynamoDB items (item store partitions)
+ITEM_SCHEMA = pa.schema(
+    [("request_id", pa.string())]
+    + [(column, pa.int64()) for column in TIMESTAMP_COLUMNS]
+    + [
+        ("request_status", CATEGORY),
+        ("sms_status", CATEGORY),
+        ("answer", CATEGORY),
+        ("total_price", pa.float64()),
+        ("reason_cancel", CATEGORY),
+    ]
+)
+
+# Items with the *_jp columns added by 2.beautify.py
+BEAUTIFIED_ITEM_SCHEMA = pa.schema(
+    list(ITEM_SCHEMA) + [(f"{column}_jp", JST_TIMESTAMP) for column in TIMESTAMP_COLUMNS]
+)
+
+# Merged SendGrid events (only the columns 3.pivot.py reads)
+EVENT_SCHEMA = pa.schema([
+    ("request_id", pa.string()),
+    ("event", CATEGORY),
+    ("timestamp", pa.int64()),
+    ("sg_template_name", CATEGORY),
+])
+
+# Request table written by 3.pivot.py
+REQUEST_SCHEMA = pa.schema([
+    ("request_id", pa.string()),
+    ("lambda_email_status", CATEGORY),
+    ("lambda_sent_at", JST_TIMESTAMP),
+    ("answer", CATEGORY),
+    ("answered_at", JST_TIMESTAMP),
+    ("lambda_sms_status", CATEGORY),
+    ("total_price", pa.float64()),
+    ("cancel_reason", CATEGORY),
+    ("sg_template_name", CATEGORY),
+    ("processed_at", JST_TIMESTAMP),
+    ("dropped_at", JST_TIMESTAMP),
+    ("deferred_at", JST_TIMESTAMP),
+    ("bounce_at", JST_TIMESTAMP),
+    ("delivered_at", JST_TIMESTAMP),
+    ("open_at", JST_TIMESTAMP),
+    ("click_at", JST_TIMESTAMP),
+    ("spamreport_at", JST_TIMESTAMP),
+])
+
+
+def conform(df: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+    """
+    Build an Arrow table with exactly the schema's columns and types.
+
+    Missing columns become nulls and extra columns are dropped. Integer
+    columns are truncated to whole numbers (epoch seconds), numeric columns
+    accept Decimal, timestamp columns take datetimes or epoch seconds, and
+    string columns take str() of non-null values (dictionary-encoded for
+    CATEGORY columns).
+    """
+    arrays = []
+    for field in schema:
+        if field.name in df.columns:
+            values = df[field.name]
+        else:
+            values = pd.Series([None] * len(df), index=df.index, dtype=object)
+
+        if pa.types.is_integer(field.type):
+            numbers = np.trunc(pd.to_numeric(values, errors="coerce").astype("float64"))
+            arrays.append(pa.array(numbers, type=field.type, from_pandas=True))
+        elif pa.types.is_floating(field.type):
+            numbers = pd.to_numeric(values, errors="coerce").astype("float64")
+            arrays.append(pa.array(numbers, type=field.type, from_pandas=True))
+        elif pa.types.is_timestamp(field.type):
+            if not isinstance(values.dtype, pd.DatetimeTZDtype):
+                values = to_jst(values)
+            arrays.append(pa.array(values, type=field.type, from_pandas=True))
+        else:
+            strings = values.astype(object).where(values.notna(), None)
+            strings = strings.map(lambda v: v if v is None or isinstance(v, str) else str(v))
+            array = pa.array(strings, type=pa.string(), from_pandas=True)
+            arrays.append(array.dictionary_encode() if pa.types.is_dictionary(field.type) else array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """
+    conform() for an Arrow table, without going through pandas.
+
+    Missing columns become nulls and extra columns are dropped; numbers are
+    cast with truncation and CATEGORY columns are dictionary-encoded.
+    """
+    arrays = []
+    for field in schema:
+        if field.name not in table.column_names:
+            arrays.append(pa.nulls(table.num_rows, field.type))
+        elif pa.types.is_dictionary(field.type):
+            arrays.append(table.column(field.name).cast(pa.string()).dictionary_encode())
+        else:
+            arrays.append(table.column(field.name).cast(field.type, safe=False))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def to_pandas(table: pa.Table) -> pd.DataFrame:
+    # Nullable dtypes keep integer epochs as integers
+    return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def to_frame(df: pd.DataFrame, schema: pa.Schema) -> pd.DataFrame:
+    """Conform a DataFrame to a schema in memory (same dtypes as a Parquet round trip)."""
+    return to_pandas(conform(df, schema))
+
+
+def write_parquet(df: pd.DataFrame, path: str, schema: pa.Schema) -> None:
+    """Write a DataFrame as compressed Parquet with an explicit schema (atomic replace)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Unique per thread too, so parallel days never share a temp file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pq.write_table(conform(df, schema), tmp_path, compression=COMPRESSION)
+    os.replace(tmp_path, path)
+
+
+def read_parquet(path: str, schema: pa.Schema) -> pd.DataFrame:
+    """Read a Parquet file written by write_parquet (empty DataFrame if it does not exist)."""
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    return to_pandas(pq.read_table(path, schema=schema))
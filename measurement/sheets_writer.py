@@ -0,0 +1,142 @@
+"""
+Quota-aware access to the Google Sheets API.
+
+Every Sheets call goes through call_with_retry, which waits for a token from a
+per-minute token bucket (the API quota is 60 read and 60 write requests per
+minute per user) and retries 429/5xx responses with jittered exponential
+backoff (only 429 for calls that must not run twice). SheetsWriter queues uploads on background threads so the next day can
+be built while the previous one is being written.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# A 429 is returned before the request is carried out, so it is safe to retry any call
+RATE_LIMIT_STATUS_CODES = {429}
+MAX_RETRIES = 6
+BASE_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 64
+
+WRITE_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))
+READ_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))
+
+
+class TokenBucket:
+    """
+    Allows rate_per_minute calls per minute, with bursts of up to capacity.
+
+    acquire() blocks until a token is available, so callers in any thread
+    together never exceed the quota.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, rate_per_minute // 6)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Shared by every Sheets call in the process
+write_bucket = TokenBucket(WRITE_REQUESTS_PER_MINUTE)
+read_bucket = TokenBucket(READ_REQUESTS_PER_MINUTE)
+
+
+def is_retryable(error, idempotent=True):
+    """
+    True for rate-limit and server errors and for dropped connections.
+
+    With idempotent=False only rate-limit errors count: after a 5xx or a lost
+    connection the call may still have been carried out.
+    """
+    # Imported on first error, so queueing uploads does not load gspread
+    import requests
+    from gspread.exceptions import APIError
+
+    if isinstance(error, APIError):
+        return error.code in (RETRYABLE_STATUS_CODES if idempotent else RATE_LIMIT_STATUS_CODES)
+    return idempotent and isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def call_with_retry(func, *args, bucket=None, idempotent=True, **kwargs):
+    """
+    Call a Sheets API method under the token bucket, backing off with jitter on retryable errors.
+
+    Pass idempotent=False for calls that must not run twice (copying a file,
+    appending a row); they are retried on 429 only.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if bucket is not None:
+            bucket.acquire()
+        name = f"sheets.{getattr(func, '__name__', 'call')}"
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            metrics.observe(name, time.perf_counter() - start)
+            return result
+        except Exception as e:
+            metrics.observe(name, time.perf_counter() - start)
+            metrics.count("sheets.errors")
+            if not is_retryable(e, idempotent) or attempt == MAX_RETRIES:
+                raise
+            metrics.count("sheets.retries")
+            delay = random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt))
+            logging.warning(f"Sheets API error ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class SheetsWriter:
+    """
+    Runs uploads on background threads and collects their failures.
+
+    submit() returns immediately; wait() blocks until every queued upload has
+    finished and returns {key: exception} for the ones that failed.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets-writer")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        future = self._executor.submit(func, *args, **kwargs)
+        with self._lock:
+            self._futures[key] = future
+        return future
+
+    def wait(self):
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        failures = {}
+        for key, future in futures.items():
+            error = future.exception()
+            if error is not None:
+                failures[key] = error
+        return failures
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
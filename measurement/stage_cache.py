@@ -0,0 +1,72 @@
+"""
+Fingerprints of each day's stage inputs, so unchanged days can be skipped.
+
+A fingerprint is a SHA-256 over everything a stage reads: the day's raw
+DynamoDB items, the listing of its S3 event objects (keys, ETags, sizes) and
+the source of the stage scripts. The fingerprint of the last successful run of
+each stage is kept per day in data/stage_manifest.json; a stage whose inputs
+hash to the same value is skipped.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+MANIFEST_PATH = "data/stage_manifest.json"
+
+_lock = threading.Lock()
+
+
+def digest(*parts) -> str:
+    """SHA-256 of JSON-serializable parts."""
+    payload = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+def frame_digest(df: pd.DataFrame, key: str = "request_id") -> str:
+    """Order-independent SHA-256 of a DataFrame's columns and values."""
+    if df is None or df.empty:
+        return digest("empty")
+    df = df[sorted(df.columns)]
+    if key in df.columns:
+        df = df.sort_values(key, kind="stable")
+    hashes = pd.util.hash_pandas_object(df.astype(str), index=False)
+    sha = hashlib.sha256(",".join(df.columns).encode())
+    sha.update(hashes.values.tobytes())
+    return sha.hexdigest()
+
+
+def source_digest(paths) -> str:
+    """SHA-256 of the given source files, so code changes invalidate old fingerprints."""
+    sha = hashlib.sha256()
+    for path in paths:
+        sha.update(Path(path).read_bytes())
+    return sha.hexdigest()
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_fresh(date_str: str, stage: str, fingerprint: str, path: str = MANIFEST_PATH) -> bool:
+    """True if the stage last succeeded for date_str with the same fingerprint."""
+    with _lock:
+        return load_manifest(path).get(date_str, {}).get(stage) == fingerprint
+
+
+def record(date_str: str, stage: str, fingerprint: str, path: str = MANIFEST_PATH) -> None:
+    """Store the fingerprint of a successful stage run (atomic replace)."""
+    with _lock:
+        manifest = load_manifest(path)
+        manifest.setdefault(date_str, {})[stage] = fingerprint
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
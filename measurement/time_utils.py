@@ -0,0 +1,34 @@
+"""
+JST timestamp formatting shared by the pipeline stages.
+"""
+from datetime import timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+JST = timezone(timedelta(hours=9))
+JST_OFFSET_SECONDS = 9 * 60 * 60
+JAPAN_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_jst(values: pd.Series) -> pd.Series:
+    """
+    Epoch seconds (int, float, Decimal or str) as tz-aware JST datetimes.
+
+    Truncated to whole seconds like int(); nulls and non-numeric values become NaT.
+    """
+    seconds = np.trunc(pd.to_numeric(values, errors="coerce").astype("float64"))
+    return pd.to_datetime(seconds, unit="s", utc=True).dt.tz_convert(JST).dt.as_unit("s")
+
+
+def format_japan_time(values: pd.Series) -> pd.Series:
+    """Render JST datetimes as 'YYYY-MM-DD HH:MM:SS' strings (object Series, None for NaT)."""
+    # strftime on naive wall-clock times is vectorized; on tz-aware ones it is per element
+    formatted = values.dt.tz_localize(None).dt.strftime(JAPAN_TIME_FORMAT)
+    return formatted.astype(object).where(values.notna(), None)
+
+
+def on_japan_date(values: pd.Series, year, month, day) -> pd.Series:
+    """True where a JST datetime falls on the given JST date (False for NaT)."""
+    start = pd.Timestamp(f"{year}-{month}-{day}").tz_localize(JST)
+    return (values >= start) & (values < start + pd.Timedelta(days=1))